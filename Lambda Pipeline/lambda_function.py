@@ -1,80 +1,697 @@
 import os
+import io
+import gzip
+import queue
+import threading
+import logging
+import json
+import time
+import hashlib
+import sqlite3
+import resource
 from os import environ
 import re
 import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import Element
 from dotenv import dotenv_values, load_dotenv
 from boto3 import client
+from botocore.exceptions import ClientError
+import math
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from pandas import DataFrame
 import spacy
 from spacy.lang.en import English
+from spacy.language import Language
 from rapidfuzz import fuzz
 from rapidfuzz.process_cpp import extract, extractOne
+from rapidfuzz.process import cdist
 from rapidfuzz.distance import Levenshtein
 from rapidfuzz.fuzz import partial_ratio, partial_token_ratio
 from datetime import datetime
+from itertools import islice
+from collections import deque
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Resources loaded once per Lambda container, and reused by warm invocations
+RESOURCES = {}
+
+
+# Columns added to each row from its (deduplicated) affiliation
+ENRICHMENT_COLUMNS = ["author_email", "additional_emails", "phone", "zipcode", "country", "institutions", "grid_institutions"]
+
+# The enrichment columns found by scanning for contact details
+CONTACT_DETAILS_COLUMNS = ["author_email", "additional_emails", "phone", "zipcode"]
+
+# Heavily repeated columns, which are held as pandas categoricals (and written as dictionary-encoded Parquet
+# columns), so that each distinct value is stored once and lookups run once per distinct value
+CATEGORICAL_COLUMNS = ["title", "year", "affiliation", "country", "institutions", "grid_institutions"]
+PARQUET_CATEGORICAL_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+# Input objects that hold PubMed article data, which are streamed from S3 in chunks of this size,
+# with up to this many chunks downloaded ahead of the parser
+PUBMED_FILE_EXTENSIONS = (".xml", ".xml.gz")
+S3_READ_CHUNK_SIZE = 1024 * 1024
+S3_PREFETCH_CHUNKS = 8
+
+# How often the prefetch thread checks whether its reader has been closed while waiting for room in the
+# queue, and how long closing the reader waits for the thread to stop
+S3_PREFETCH_POLL_SECONDS = 0.1
+S3_PREFETCH_STOP_TIMEOUT = 5
+
+# Outputs are streamed to S3 in parts of this size (S3's minimum is 5 MB), with this many uploading at once
+S3_PART_SIZE = 8 * 1024 * 1024
+S3_UPLOAD_CONCURRENCY = 4
+
+# The GRID snapshot folder (in the GRID data folder), which holds one memory-mappable Arrow file per table,
+# and the version of its format
+GRID_SNAPSHOT_DIR_NAME = "grid_snapshot"
+GRID_SNAPSHOT_VERSION = 2
+
+# The GRID .csv files a snapshot is built from, which it is checked against (when they are present)
+GRID_SOURCE_FILE_NAMES = ["institutes.csv", "aliases.csv"]
+
+# The maximum number of values bound to a single SQLite query
+SQLITE_BATCH_SIZE = 500
+
+# The format of the article index, which is rebuilt if this changes
+ARTICLE_INDEX_VERSION = 2
+
+# How many rows of an earlier output are read at a time, when copying unchanged articles from it
+PREVIOUS_OUTPUT_BATCH_ROWS = 65536
+
+# How many queries are scored against all GRID names per cdist call (bounds the score matrix size)
+CDIST_CHUNK_SIZE = 64
+
+# The output tables written in Parquet format, each with its schema and the columns identifying a row
+PARQUET_TABLES = {
+    "articles": {
+        "schema": pa.schema([("pmid", pa.string()), ("title", PARQUET_CATEGORICAL_TYPE), ("year", PARQUET_CATEGORICAL_TYPE),
+                             ("keyword_list", pa.list_(pa.string())), ("mesh_list", pa.list_(pa.string()))]),
+        "keys": ["pmid"]
+    },
+    "authors": {
+        "schema": pa.schema([("pmid", pa.string()), ("author_index", pa.int32()), ("forename", pa.string()),
+                             ("lastname", pa.string()), ("full_name", pa.string()), ("initials", pa.string())]),
+        "keys": ["pmid", "author_index"]
+    },
+    "affiliations": {
+        "schema": pa.schema([("pmid", pa.string()), ("author_index", pa.int32()), ("affiliation_index", pa.int32()),
+                             ("affiliation", PARQUET_CATEGORICAL_TYPE), ("identity", pa.string())]
+                            + [(column, PARQUET_CATEGORICAL_TYPE if column in CATEGORICAL_COLUMNS else pa.string())
+                               for column in ENRICHMENT_COLUMNS]),
+        "keys": ["pmid", "author_index", "affiliation_index"]
+    }
+}
+PARQUET_COMPRESSION = "zstd"
+
+# The columns of the flattened rows, in order
+ROW_COLUMNS = ["title", "pmid", "year", "keyword_list", "mesh_list", "author_index", "affiliation_index",
+               "forename", "lastname", "full_name", "initials", "identity", "affiliation"]
+
+# Columns locating each flattened row within its article, which the flat .csv output leaves out
+ROW_KEY_COLUMNS = ["author_index", "affiliation_index"]
+
+# Words marking the part of an affiliation naming the institution, in order of preference (departments are
+# often called centres or laboratories, so a university or hospital segment is picked over them)
+INSTITUTION_KEYWORDS = ("university", "hospital", "center", "centre", "laboratory")
+
+# Comma-separated affiliation segments longer than this (in words) are left to spaCy to pick the institution from
+INSTITUTION_SEGMENT_MAX_WORDS = 10
+
+# Finds the phone numbers and postcodes in an affiliation in a single scan. Each alternative is a named group,
+# tried in this order at each position, so e.g. the digits of a phone number are never taken for a postcode.
+# Fax numbers are matched only so that they are skipped. All of them start with a capital, a digit or '+', and
+# the lookahead lets the scan skip quickly past every other position
+CONTACT_DETAILS_PATTERN = re.compile(r"""(?=[A-Z0-9+])(?:
+    (?<!\w)(?P<fax>Fax[.:]*\s*\+?\d[\d ()./-]{5,}\d)
+  | (?<!\w)(?:(?:Tel|Telephone|Phone|Ph)[.:]*\s*)(?P<phone>\+?\(?\d[\d ()./-]{5,}\d)
+  | (?<![\w+])(?P<international_phone>\+\d[\d ()./-]{6,}\d)
+  | (?<!\w)(?P<uk_postcode>[A-Z]{1,2}\d[A-Z\d]?\ \d[A-Z]{2})(?!\w)
+  | (?<!\w)(?P<ca_postcode>[A-Z]\d[A-Z]\ ?\d[A-Z]\d)(?!\w)
+  | (?<![\w-])(?:D-)?(?P<zipcode>\d{5}(?:-\d{4})?)(?![\w-])
+  | (?<![\w-])(?P<cn_postcode>\d{6})(?![\w-])
+)""", re.VERBOSE)
+# Email addresses can start with any letter, so they are only scanned for (in the same pass) if there is an '@'
+CONTACT_DETAILS_WITH_EMAIL_PATTERN = re.compile(r"""
+    (?<![\w.%+-])(?P<email>[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,})
+  | """ + CONTACT_DETAILS_PATTERN.pattern, re.VERBOSE)
+PHONE_GROUPS = ("phone", "international_phone")
+POSTCODE_GROUPS = ("zipcode", "uk_postcode", "ca_postcode")
+
+# Any six digit number (e.g. a grant number) could be a Chinese postcode, so they are only taken as postcodes if
+# China is named in the same comma-separated segment or one either side of it
+CHINA_PATTERN = re.compile(r"\b(?:China|CHINA|PRC)\b")
+
+# spaCy components that named entity recognition does not need (the ner component has its own internal
+# tok2vec, so the shared one only feeds the tagger and parser)
+NER_EXCLUDED_COMPONENTS = ["tok2vec", "tagger", "parser", "senter", "attribute_ruler", "lemmatizer"]
+
+# Other ways affiliations commonly name countries, mapped to the country's name in world_countries.txt
+COUNTRY_VARIANTS = {
+    "USA": "United States", "U.S.A.": "United States", "U.S.": "United States", "US": "United States",
+    "United States of America": "United States",
+    "UK": "United Kingdom", "U.K.": "United Kingdom", "Great Britain": "United Kingdom", "England": "United Kingdom",
+    "Scotland": "United Kingdom", "Wales": "United Kingdom", "Northern Ireland": "United Kingdom",
+    "P.R. China": "China", "P. R. China": "China", "PR China": "China", "PRC": "China",
+    "People's Republic of China": "China",
+    "South Korea": "Korea South", "Republic of Korea": "Korea South", "Korea": "Korea South",
+    "North Korea": "Korea North", "Democratic People's Republic of Korea": "Korea North", "DPRK": "Korea North",
+    "The Netherlands": "Netherlands", "Holland": "Netherlands",
+    "Ireland": "Ireland {Republic}", "Republic of Ireland": "Ireland {Republic}",
+    "Democratic Republic of the Congo": "Congo {Democratic Rep}", "DR Congo": "Congo {Democratic Rep}",
+    "Republic of the Congo": "Congo",
+    "Myanmar": "Myanmar, {Burma}", "Burma": "Myanmar, {Burma}",
+    "Russia": "Russian Federation", "Czechia": "Czech Republic", "Viet Nam": "Vietnam",
+    "Türkiye": "Turkey", "Turkiye": "Turkey", "Côte d'Ivoire": "Ivory Coast", "Cote d'Ivoire": "Ivory Coast",
+    "Bosnia and Herzegovina": "Bosnia Herzegovina", "North Macedonia": "Macedonia", "Eswatini": "Swaziland",
+    "Burkina Faso": "Burkina", "Central African Republic": "Central African Rep", "Timor-Leste": "East Timor",
+    "Brunei Darussalam": "Brunei", "Syrian Arab Republic": "Syria", "Lao PDR": "Laos", "UAE": "United Arab Emirates",
+    "Antigua and Barbuda": "Antigua & Deps", "Trinidad and Tobago": "Trinidad & Tobago",
+    "Saint Kitts and Nevis": "St Kitts & Nevis", "Saint Lucia": "St Lucia",
+    "Saint Vincent and the Grenadines": "Saint Vincent & the Grenadines", "Sao Tome and Principe": "Sao Tome & Principe"
+}
+
+# Countries whose names in world_countries.txt are lookup labels (qualified, reversed or shortened), mapped to the
+# name written to the country column
+COUNTRY_DISPLAY_NAMES = {
+    "Ireland {Republic}": "Ireland", "Congo {Democratic Rep}": "Democratic Republic of the Congo",
+    "Myanmar, {Burma}": "Myanmar", "Korea South": "South Korea", "Korea North": "North Korea",
+    "Central African Rep": "Central African Republic", "Antigua & Deps": "Antigua and Barbuda",
+    "Burkina": "Burkina Faso", "Bosnia Herzegovina": "Bosnia and Herzegovina"
+}
+
+# Places whose names contain a country's name (e.g. 'Wales' in New South Wales), mapped to the country they are
+# in. They are matched along with the countries, so the longer place name wins over the country inside it.
+# Georgia the state is only recognised after a city, as affiliations also name Georgia the country
+SUBNATIONAL_NAMES = {
+    "New South Wales": "Australia", "New Mexico": "United States",
+    "Atlanta, Georgia": "United States", "Athens, Georgia": "United States", "Augusta, Georgia": "United States",
+    "Savannah, Georgia": "United States", "Macon, Georgia": "United States", "Columbus, Georgia": "United States",
+    "Lebanon, New Hampshire": "United States", "Lebanon, NH": "United States"
+}
+
+# Words that may directly follow a country at the end of an affiliation. Any other capitalised word means the
+# country's name is part of a longer name (e.g. 'Jordan Hall' or 'China Medical University'), so isn't matched
+COUNTRY_FOLLOWING_WORDS = ["Tel", "Telephone", "Phone", "Fax", "Electronic", "Email", "E-mail"]
+
+# Finds the peak RSS (in kB) in /proc/self/status
+VM_HWM_PATTERN = re.compile(rb"VmHWM:\s+(\d+)")
+
+# Maps the tags of an <Author>'s name elements to their output keys
+AUTHOR_NAME_FIELDS = {
+    "ForeName": "forename",
+    "LastName": "lastname",
+    "Initials": "initials"
+}
+
+
+class PeakRssMonitor:
+    """
+    Reads and resets the peak resident memory (RSS)
+    of the process, using the kernel's high-water
+    mark (VmHWM), which writing '5' to clear_refs
+    resets to the current RSS. Outside Linux the
+    peak can't be reset, so the process's lifetime
+    peak (from getrusage) is read instead
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.status_fd = None
+        self.clear_refs_fd = None
+
+    def open(self) -> bool:
+        """
+        Opens this process's /proc files (again, in
+        a forked child), returning whether they
+        could be opened
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            try:
+                self.status_fd = os.open("/proc/self/status", os.O_RDONLY)
+                self.clear_refs_fd = os.open("/proc/self/clear_refs", os.O_WRONLY)
+            except OSError:
+                self.status_fd = self.clear_refs_fd = None
+
+        return self.clear_refs_fd is not None
+
+    def read_mb(self) -> float:
+        """
+        Returns the peak RSS since it was last reset,
+        in MB
+        """
+        if not self.open():
+            # ru_maxrss is in kilobytes on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        return int(VM_HWM_PATTERN.search(os.pread(self.status_fd, 8192, 0)).group(1)) / 1024
+
+    def reset(self) -> None:
+        """
+        Resets the peak RSS to the current RSS
+        """
+        if self.open():
+            os.write(self.clear_refs_fd, b"5")
+
+
+class StageMetrics:
+    """
+    Records the wall time, CPU time, number of
+    calls and rows of each stage of a pipeline
+    run, along with the peak memory (RSS) reached
+    during any one call of the stage. Stages may be
+    nested, in which case the outer stage's times
+    leave out those of the inner ones, so the stage
+    times add up to the run's total (the outer
+    stage's peak memory includes the inner ones').
+    CPU time is that of the whole process, so it
+    includes any background download or upload
+    threads running during the stage
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Clears the recorded stages, starting the
+        measurement of a new run
+        """
+        self.stages = {}
+        self.active = []
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.peak_rss_mb = 0.0
+        peak_rss.reset()
+
+    def take_peak_rss(self) -> None:
+        """
+        Reads and resets the peak RSS since the last
+        stage started or finished, adding it to the
+        run's peak and to that of the enclosing stage
+        """
+        peak_rss_mb = peak_rss.read_mb()
+        peak_rss.reset()
+
+        self.peak_rss_mb = max(self.peak_rss_mb, peak_rss_mb)
+
+        if self.active:
+            self.active[-1]["peak_rss_mb"] = max(self.active[-1]["peak_rss_mb"], peak_rss_mb)
+
+    def get_stage(self, name: str) -> dict:
+        """
+        Returns the record of the given stage,
+        creating it if needed
+        """
+        return self.stages.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0, "rows": 0, "peak_rss_mb": 0.0})
+
+    @contextmanager
+    def stage(self, name: str, rows: int = 0):
+        """
+        Measures the code inside the with block as
+        one call of the given stage, handling the
+        given number of rows
+        """
+        self.take_peak_rss()
+
+        # Start times, the time taken by the stages nested inside this one, and the peak RSS so far
+        timing = {"wall": time.perf_counter(), "cpu": time.process_time(), "nested_wall": 0.0, "nested_cpu": 0.0,
+                  "peak_rss_mb": 0.0}
+        self.active.append(timing)
+
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - timing["wall"]
+            cpu = time.process_time() - timing["cpu"]
+
+            self.take_peak_rss()
+            self.active.pop()
+
+            if self.active:
+                self.active[-1]["nested_wall"] += wall
+                self.active[-1]["nested_cpu"] += cpu
+
+            record = self.get_stage(name)
+            record["wall_s"] += wall - timing["nested_wall"]
+            record["cpu_s"] += cpu - timing["nested_cpu"]
+            record["calls"] += 1
+            record["rows"] += rows
+            record["peak_rss_mb"] = max(record["peak_rss_mb"], timing["peak_rss_mb"])
+
+            if self.active:
+                self.active[-1]["peak_rss_mb"] = max(self.active[-1]["peak_rss_mb"], timing["peak_rss_mb"])
+
+    def add_rows(self, name: str, rows: int) -> None:
+        """
+        Adds to the rows handled by a stage, for
+        when they are only known once it finishes
+        """
+        self.get_stage(name)["rows"] += rows
+
+    def iterate(self, name: str, iterable: Iterable, count_rows=None) -> Iterator:
+        """
+        Measures the fetching of each item from an
+        iterator (e.g. a lazy parser) as a call of
+        the given stage, leaving out the caller's
+        work on the item. Each item counts as one
+        row, unless count_rows is given to count them
+        """
+        iterator = iter(iterable)
+
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+
+            self.add_rows(name, count_rows(item) if count_rows else 1)
+
+            yield item
+
+    def summary(self) -> dict:
+        """
+        Returns the run's totals and the record of
+        each stage (in the order they first ran), as
+        a JSON-serialisable dictionary
+        """
+        wall = time.perf_counter() - self.start_wall
+
+        return {
+            "wall_s": round(wall, 4),
+            "cpu_s": round(time.process_time() - self.start_cpu, 4),
+            "unstaged_wall_s": round(wall - sum(record["wall_s"] for record in self.stages.values()), 4),
+            "peak_rss_mb": round(max(self.peak_rss_mb, peak_rss.read_mb()), 1),
+            "stages": {name: {key: round(value, 1 if key == "peak_rss_mb" else 4) if isinstance(value, float) else value
+                              for key, value in record.items()}
+                       for name, record in self.stages.items()}
+        }
+
+
+# The process's peak RSS, which is reset at each stage boundary
+peak_rss = PeakRssMonitor()
+
+# Stage measurements of the current run, which is reset at the start of each one
+metrics = StageMetrics()
 
 
-def download_pubmed_xml_file(s3: client, input_bucket_name: str, folder_prefix: str, local_file_path: str):
+def list_pubmed_objects(s3: client, input_bucket_name: str, folder_prefix: str) -> list[dict]:
     """
-    Downloads .xml file objects from the specified
-    bucket, if they have the provided prefix
+    Returns every .xml (or gzipped .xml.gz) object
+    with the provided prefix, following the listing
+    across as many pages as needed, from the oldest
+    to the most recently modified
     """
-    objects = s3.list_objects_v2(Bucket=input_bucket_name, Prefix=folder_prefix)
-    
-    most_recent_file = None
-    most_recent_date = None
-    for obj in objects.get('Contents', []):
-        if obj['Key'].endswith('.xml'):
-            if most_recent_date is None or obj['LastModified'] > most_recent_date:
-                most_recent_file = obj['Key']
-                most_recent_date = obj['LastModified']
-    
-    if most_recent_file:
-        s3.download_file(input_bucket_name, most_recent_file, local_file_path)
+    list_args = {"Bucket": input_bucket_name, "Prefix": folder_prefix}
+    pubmed_objects = []
 
+    with metrics.stage("list_input"):
+        while True:
+            objects = s3.list_objects_v2(**list_args)
 
-def get_author_info_from_article_num(root: Element, article_num: int) -> dict:
+            pubmed_objects.extend(obj for obj in objects.get('Contents', []) if obj['Key'].endswith(PUBMED_FILE_EXTENSIONS))
+
+            if not objects.get('IsTruncated'):
+                break
+
+            list_args["ContinuationToken"] = objects['NextContinuationToken']
+
+    return sorted(pubmed_objects, key=lambda obj: obj['LastModified'])
+
+
+def find_most_recent_pubmed_key(s3: client, input_bucket_name: str, folder_prefix: str) -> str:
+    """
+    Returns the key of the most recently modified
+    .xml (or gzipped .xml.gz) object with the
+    provided prefix, or None if there isn't one
+    """
+    pubmed_objects = list_pubmed_objects(s3, input_bucket_name, folder_prefix)
+
+    return pubmed_objects[-1]['Key'] if pubmed_objects else None
+
+
+def download_manifest(s3: client, bucket_name: str, key: str) -> dict:
+    """
+    Returns the ingestion manifest (the input keys
+    already processed, each with its ETag and
+    output), or an empty one if it doesn't exist
+    """
+    try:
+        body = s3.get_object(Bucket=bucket_name, Key=key)["Body"]
+    except ClientError as error:
+        if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return {}
+        raise
+
+    with body:
+        return json.loads(body.read())
+
+
+def upload_manifest(s3: client, bucket_name: str, key: str, manifest: dict) -> None:
+    """
+    Uploads the ingestion manifest to S3, so that
+    later runs skip the files it lists
+    """
+    s3.put_object(Bucket=bucket_name, Key=key, Body=json.dumps(manifest, indent=2).encode("utf-8"))
+
+
+def find_unprocessed_pubmed_objects(pubmed_objects: list[dict], manifest: dict) -> list[dict]:
+    """
+    Returns the objects that aren't in the manifest,
+    or whose contents (ETag) have changed since
+    they were processed
+    """
+    return [obj for obj in pubmed_objects if manifest.get(obj['Key'], {}).get("etag") != obj['ETag']]
+
+
+def get_pubmed_file_stem(key: str) -> str:
+    """
+    Returns the file name of a PubMed object's key,
+    without its .xml or .xml.gz extension
+    """
+    file_name = key.rsplit("/", 1)[-1]
+
+    for extension in PUBMED_FILE_EXTENSIONS:
+        file_name = file_name.removesuffix(extension)
+
+    return file_name
+
+
+def iter_streamed_pubmed_files(s3: client, input_bucket_name: str, pubmed_objects: list[dict]) -> Iterator[tuple[dict, object]]:
+    """
+    Opens each object in turn as a stream (see
+    open_pubmed_xml_stream), yielding the object
+    with its stream, which is closed once the
+    consumer moves on
+    """
+    for obj in pubmed_objects:
+        with open_pubmed_xml_stream(s3, input_bucket_name, obj['Key']) as pubmed_xml_source:
+            yield obj, pubmed_xml_source
+
+
+class PrefetchingReader(io.RawIOBase):
+    """
+    A readable file object over a stream (such as
+    an S3 object's body), which a background thread
+    keeps reading ahead of the consumer. This lets
+    the download continue while the bytes already
+    received are being parsed
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = queue.Queue(maxsize=S3_PREFETCH_CHUNKS)
+        self.buffer = b""
+        self.finished = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.prefetch, daemon=True)
+        self.thread.start()
+
+    def put(self, item) -> bool:
+        """
+        Waits for room in the queue for the item,
+        giving up (and returning False) if the
+        reader is closed in the meantime
+        """
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=S3_PREFETCH_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def prefetch(self) -> None:
+        """
+        Reads the stream chunk by chunk into the
+        queue, ending with an empty chunk (or the
+        exception that stopped it). Stops early if
+        the reader is closed
+        """
+        try:
+            while not self.stopped.is_set() and (chunk := self.stream.read(S3_READ_CHUNK_SIZE)):
+                if not self.put(chunk):
+                    return
+            self.put(b"")
+        except Exception as e:
+            self.put(e)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        """
+        Fills the buffer from the prefetched chunks,
+        waiting for the next chunk if none are ready
+        """
+        if not self.buffer and not self.finished:
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            self.buffer = chunk
+            self.finished = not chunk
+
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+
+        return size
+
+    def close(self) -> None:
+        """
+        Stops the prefetch thread (even if the
+        consumer stopped reading early), drops any
+        prefetched chunks and closes the stream
+        """
+        if self.closed:
+            return
+
+        # The thread notices within S3_PREFETCH_POLL_SECONDS if it is waiting for room in the queue
+        self.stopped.set()
+        self.stream.close()
+        self.thread.join(timeout=S3_PREFETCH_STOP_TIMEOUT)
+
+        while True:
+            try:
+                self.chunks.get_nowait()
+            except queue.Empty:
+                break
+
+        super().close()
+
+
+class StreamingGzipFile(gzip.GzipFile):
+    """
+    Decompresses a gzipped file object as it is
+    read, closing that file object when it is
+    closed (which gzip.GzipFile does not do)
+    """
+
+    def __init__(self, source):
+        super().__init__(fileobj=source, mode="rb")
+        self.source = source
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self.source.close()
+
+
+def open_pubmed_xml_stream(s3: client, input_bucket_name: str, key: str):
+    """
+    Opens an S3 object as a binary file object that
+    streams its (decompressed, for .xml.gz files)
+    contents as they are downloaded, ready for
+    incremental parsing without a local copy
+    """
+    logger.info("Streaming s3://%s/%s", input_bucket_name, key)
+
+    body = s3.get_object(Bucket=input_bucket_name, Key=key)["Body"]
+    source = io.BufferedReader(PrefetchingReader(body), buffer_size=S3_READ_CHUNK_SIZE)
+
+    if key.endswith(".gz"):
+        return StreamingGzipFile(source)
+
+    return source
+
+
+def get_element_text(element: Element, path: str) -> str:
+    """
+    Returns the text of the first element matching
+    the given path, or None if there is no match
+    """
+    found = element.find(path)
+
+    return found.text if found is not None else None
+
+
+def get_author_info(author: Element) -> dict:
     """
     Returns a dictionary containing information
-    on a given article, where the information on 
-    the authors is a list of dictionaries (each
-    such dict = 1 author)
+    on a single <Author> element. The element is
+    walked once, with each child's tag looked up
+    in AUTHOR_NAME_FIELDS rather than searching
+    the author's subtree once per field
     """
-    article = root.findall(".//PubmedArticle")[article_num]
+    fields = {}
+    affiliation_list = []
+
+    for child in author:
+
+        if child.tag == "AffiliationInfo":
+            for info in child:
+                if info.tag == "Affiliation":
+                    affiliation_list.append(info.text)
+                elif info.tag == "Identifier" and info.get("Source") == "GRID":
+                    fields.setdefault("identity", info.text)
+            continue
+
+        field = AUTHOR_NAME_FIELDS.get(child.tag)
+        if field is not None:
+            fields.setdefault(field, child.text)
+
+    return {
+        "forename": fields.get("forename"),
+        "lastname": fields.get("lastname"),
+        "initials": fields.get("initials"),
+        "identity": fields.get("identity"),
+        "affiliation_name": affiliation_list[0] if affiliation_list else None,
+        "affiliation": affiliation_list
+    }
+
 
+def get_article_info(article: Element) -> dict:
+    """
+    Returns a dictionary containing information
+    on a single <PubmedArticle> element, where the
+    information on the authors is a list of
+    dictionaries (each such dict = 1 author)
+    """
     authors = article.findall(".//AuthorList/Author")
 
-    title = article.find(".//ArticleTitle").text if article.find(".//ArticleTitle").text is not None else None
-    pmid = article.find(".//PMID").text if article.find(".//PMID").text is not None else None
-    year = article.find(".//DateRevised/Year").text if article.find(".//DateRevised/Year").text is not None else None
+    title = get_element_text(article, ".//ArticleTitle")
+    pmid = get_element_text(article, ".//PMID")
+    year = get_element_text(article, ".//DateRevised/Year")
 
     keyword_list = [keyword.text for keyword in article.findall(".//KeywordList/Keyword")]
 
     mesh_list = [mesh.text for mesh in article.findall(".//MeshHeading/DescriptorName[@UI]")]
     
-    authors_info = []
-    
-    for author in authors:
-
-        forename = author.find(".//ForeName").text if author.find(".//ForeName") is not None else None
-        lastname = author.find(".//LastName").text if author.find(".//LastName") is not None else None
-        initials = author.find(".//Initials").text if author.find(".//Initials") is not None else None
-        affiliation_name_pubmed = author.find(".//AffiliationInfo/Affiliation").text if author.find(".//AffiliationInfo/Affiliation") is not None else None
-        identity = author.find(".//AffiliationInfo/Identifier[@Source='GRID']").text if author.find(".//AffiliationInfo/Identifier[@Source='GRID']") is not None else None
-
-        affiliation_list = [aff.text for aff in author.findall(".//Affiliation")]
-
-        author_info = {
-            "forename": forename,
-            "lastname": lastname,
-            "initials": initials,
-            "identity": identity,
-            "affiliation_name": affiliation_name_pubmed,
-            "affiliation": affiliation_list
-        }
-        authors_info.append(author_info)
+    authors_info = [get_author_info(author) for author in authors]
     
     output = {
         "title": title,
@@ -88,117 +705,1073 @@ def get_author_info_from_article_num(root: Element, article_num: int) -> dict:
     return output
 
 
-def get_all_data_for_each_article(root: Element, article_cap: int) -> list[dict]:
+def get_author_info_from_article_num(root: Element, article_num: int) -> dict:
+    """
+    Returns a dictionary containing information
+    on a given article, where the information on 
+    the authors is a list of dictionaries (each
+    such dict = 1 author)
+    """
+    article = root.findall(".//PubmedArticle")[article_num]
+
+    return get_article_info(article)
+
+
+def stream_pubmed_articles(xml_source) -> Iterator[dict]:
     """
-    Will get information on all articles up
-    until the 'article cap' is reached
+    Incrementally parses a PubMed .xml file (a path
+    or a binary file object), yielding one article
+    dictionary at a time. Each <PubmedArticle> is
+    cleared once processed, so memory use stays flat
+    regardless of the size of the file
     """
-    data = []
+    root = None
 
-    for i in range(article_cap):
+    for event, element in ET.iterparse(xml_source, events=("start", "end")):
 
-        data.append(get_author_info_from_article_num(root, i))
+        if root is None:
+            root = element
 
-    return data
+        if event == "end" and element.tag == "PubmedArticle":
+            yield get_article_info(element)
 
+            # Drop the processed article (and anything before it) from the tree
+            element.clear()
+            root.clear()
 
-def flatten_article_data(article_data: list[dict]) -> list[dict]:
+
+def get_all_data_for_each_article(root: Element, article_cap: int = None) -> list[dict]:
     """
-    'Flattens' the article data, so that each
-    resulting dictionary contains one article
-    title, one author's information, and one
-    affiliation
+    Will get information on all articles (or
+    only up until the 'article cap' is reached),
+    visiting each article exactly once
     """
-    flattened_data = []
+    articles = root.iterfind(".//PubmedArticle")
+
+    if article_cap is not None:
+        articles = islice(articles, article_cap)
+
+    return [get_article_info(article) for article in articles]
+
+
+def flatten_article_data(article_data: Iterable[dict]) -> dict[str, list]:
+    """
+    'Flattens' the article data, so that each row
+    contains one article title, one author's
+    information, and one affiliation. The rows are
+    built as columns (a list of values for each of
+    ROW_COLUMNS), so that a DataFrame can be made
+    without creating a dictionary for every row
+    """
+    columns = {column: [] for column in ROW_COLUMNS}
 
     for article in article_data:
-        for author in article['authors_info']:
-            for affiliation in author['affiliation']:
-                flattened_dict = {
-                    "title": article['title'],
-                    "pmid": article['pmid'],
-                    "year": article['year'],
-                    "keyword_list": article['keyword_list'],
-                    "mesh_list": article['mesh_list'],
-                    "forename": author['forename'],
-                    "lastname": author['lastname'],
-                    "full_name": author['forename'] + " " + author['lastname'],
-                    "initials": author['initials'],
-                    "identity": author['identity'],
-                    "affiliation": affiliation
-                }
-                flattened_data.append(flattened_dict)
-
-    return flattened_data
-
-
-def find_email_zipcode(df: DataFrame) -> DataFrame:
-    """
-    Uses RegEx to pull out email addresses
-    and zipcodes from an author's 'affiliation'
-    data
-    """
-    df['author_email'] = df['affiliation'].str.extract(r'([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})')
-    df['zipcode'] = df['affiliation'].str.extract(r'(\b\d{5}(?:-\d{4})?\b|\b[A-Z]\d[A-Z] \d[A-Z]\b|\b[A-Z]\d[A-Z]\d[A-Z]\b)', flags=re.IGNORECASE)
+        for author_index, author in enumerate(article['authors_info']):
+            affiliation_count = len(author['affiliation'])
+
+            if not affiliation_count:
+                continue
+
+            article_values = {key: article[key] for key in ("title", "pmid", "year", "keyword_list", "mesh_list")}
+            author_values = {
+                "author_index": author_index,
+                "forename": author['forename'],
+                "lastname": author['lastname'],
+                "full_name": " ".join(filter(None, (author['forename'], author['lastname']))),
+                "initials": author['initials'],
+                "identity": author['identity']
+            }
+
+            for column, value in (article_values | author_values).items():
+                columns[column].extend([value] * affiliation_count)
+
+            columns["affiliation_index"].extend(range(affiliation_count))
+            columns["affiliation"].extend(author['affiliation'])
+
+    return columns
+
+
+def select_rows(rows: dict[str, list], indexes: list[int]) -> dict[str, list]:
+    """
+    Returns the flattened rows (as columns) at the
+    given positions
+    """
+    return {column: [values[i] for i in indexes] for column, values in rows.items()}
+
+
+def scan_contact_details(affiliation: str) -> tuple:
+    """
+    Scans an affiliation once, returning (in the
+    order of CONTACT_DETAILS_COLUMNS) its first
+    email address, any other email addresses, its
+    first phone number and its first postcode (a
+    US ZIP code, or a UK, Canadian, German or
+    Chinese postcode, the last only if China is
+    named next to it)
+    """
+    if not isinstance(affiliation, str):
+        return None, None, None, None
+
+    pattern = CONTACT_DETAILS_WITH_EMAIL_PATTERN if "@" in affiliation else CONTACT_DETAILS_PATTERN
+
+    emails = []
+    phone = None
+    zipcode = None
+
+    for match in pattern.finditer(affiliation):
+        if match.lastgroup == "email":
+            emails.append(match.group("email"))
+        elif match.lastgroup in PHONE_GROUPS:
+            phone = phone or match.group(match.lastgroup)
+        elif match.lastgroup in POSTCODE_GROUPS:
+            zipcode = zipcode or match.group(match.lastgroup)
+        elif match.lastgroup == "cn_postcode" and zipcode is None and is_near_china(affiliation, match.start(), match.end()):
+            zipcode = match.group("cn_postcode")
+
+    return (emails[0] if emails else None), ("; ".join(emails[1:]) or None), phone, zipcode
+
+
+def is_near_china(affiliation: str, start: int, end: int) -> bool:
+    """
+    Returns whether China is named in the comma
+    (or semicolon) separated segment of the
+    affiliation holding the given span, or in the
+    segments either side of it
+    """
+    before = re.split(r"[,;]", affiliation[:start])[-2:]
+    after = re.split(r"[,;]", affiliation[end:])[:2]
+
+    return CHINA_PATTERN.search(",".join(before) + affiliation[start:end] + ",".join(after)) is not None
+
+
+def find_contact_details(df: DataFrame) -> DataFrame:
+    """
+    Adds the email address(es), phone number and
+    postcode columns from an author's 'affiliation'
+    data, scanning each unique affiliation once
+    """
+    codes, unique_affiliations = pd.factorize(df['affiliation'], use_na_sentinel=False)
+
+    details = np.array([scan_contact_details(affiliation) for affiliation in unique_affiliations],
+                       dtype=object).reshape(-1, len(CONTACT_DETAILS_COLUMNS))
+
+    for i, column in enumerate(CONTACT_DETAILS_COLUMNS):
+        df[column] = details[codes, i]
 
     return df
 
 
-def identify_countries(docs, world_countries: list[str]) -> list[str]:
+def load_ner_model(model_name: str = "en_core_web_sm") -> Language:
     """
-    Attempts to extract 'country' entities
-    from an author's 'affiliation' data
+    Loads the spaCy model with only the
+    components needed for named entity
+    recognition
     """
-    world_countries = set(world_countries)
+    return spacy.load(model_name, exclude=NER_EXCLUDED_COMPONENTS)
 
-    countries_list = []
 
-    for doc in docs:
-        countries_found = [ent.text for ent in doc.ents if ent.label_ == "GPE" and ent.text.title() in world_countries]
-        if countries_found:
-            countries_list.append(countries_found[-1])
-        else:
-            countries_list.append(None)
-    
-    return countries_list
+def extract_entities(nlp: Language, texts: list[str], batch_size: int, n_process: int) -> list[list[tuple[str, str]]]:
+    """
+    Runs named entity recognition over the given
+    texts in batches (optionally across several
+    processes), returning only the (text, label)
+    pairs of each text's entities
+    """
+    docs = nlp.pipe((text or "" for text in texts), batch_size=batch_size, n_process=n_process)
 
+    return [[(ent.text, ent.label_) for ent in doc.ents] for doc in docs]
 
-def identify_institutions(docs, grid_institutions_df: DataFrame) -> tuple(list[str]):
+
+class CountryMatcher:
     """
-    Attempts to extract 'organisation' entities
-    from an author's 'affiliation' data, and then
-    tries to match the organisation to one from the
-    institutes.csv file
+    Finds the countries named in affiliations with
+    a single compiled regular expression, built from
+    world_countries.txt, COUNTRY_VARIANTS and
+    SUBNATIONAL_NAMES (each as written, or in
+    capitals). Every match is mapped to its name in
+    world_countries.txt, or its display name in
+    COUNTRY_DISPLAY_NAMES if it has one. Names
+    followed by another capitalised word (other
+    than those in COUNTRY_FOLLOWING_WORDS) are
+    not matched
+    """
+
+    def __init__(self, world_countries: list[str]):
+        self.country_names = {name: name for name in world_countries if name}
+        self.country_names.update(COUNTRY_VARIANTS)
+        self.country_names.update(SUBNATIONAL_NAMES)
+        self.country_names.update({name.upper(): country for name, country in self.country_names.items()})
+        self.country_names = {name: COUNTRY_DISPLAY_NAMES.get(country, country) for name, country in self.country_names.items()}
+
+        following_words = "|".join(map(re.escape, COUNTRY_FOLLOWING_WORDS))
+
+        self.pattern = re.compile(r"(?<!\w)" + self.build_pattern(self.build_trie(self.country_names))
+                                  + rf"(?!\w)(?!\s+(?!(?:{following_words})\b)[A-Z][a-z])")
+
+    @staticmethod
+    def build_trie(names: Iterable[str]) -> dict:
+        """
+        Builds a character trie of the names, where
+        an empty key marks the end of a name
+        """
+        trie = {}
+
+        for name in names:
+            node = trie
+            for character in name:
+                node = node.setdefault(character, {})
+            node[""] = {}
+
+        return trie
+
+    @classmethod
+    def build_pattern(cls, node: dict) -> str:
+        """
+        Turns a trie into a regular expression, so
+        names sharing a prefix are only compared
+        once. Longer names are tried first, so e.g.
+        'Guinea-Bissau' is matched rather than 'Guinea'
+        """
+        branches = [re.escape(character) + cls.build_pattern(child) for character, child in sorted(node.items()) if character]
+
+        if not branches:
+            return ""
+
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+
+        return f"(?:{pattern})?" if "" in node else pattern
+
+    def match(self, text: str) -> str:
+        """
+        Returns the last country named in the text,
+        or None if there isn't one
+        """
+        found = self.pattern.findall(text or "")
+
+        return self.country_names[found[-1]] if found else None
+
+
+def identify_countries(affiliations: list[str], country_matcher: CountryMatcher) -> list[str]:
+    """
+    Attempts to extract the country from each
+    author's 'affiliation' data, taking the last
+    country mentioned
+    """
+    return [country_matcher.match(affiliation) for affiliation in affiliations]
+
+
+class GridMatcher:
+    """
+    Fuzzy matches institution names against the
+    GRID institute names. The names are indexed
+    once by length and by trigram, so each match
+    only scores the names that could possibly
+    reach the similarity threshold, rather than
+    every name in institutes.csv
+    """
+
+    def __init__(self, names: list[str], gram_size: int = 3, postings: dict[str, np.ndarray] = None):
+        self.gram_size = gram_size
+        self.names = [name if isinstance(name, str) else None for name in names]
+        self.lengths = np.array([len(name) if name is not None else -1 for name in self.names], dtype=np.int32)
+        self.postings = postings if postings is not None else self.build_postings()
+
+    def build_postings(self) -> dict[str, np.ndarray]:
+        """
+        Builds the index from each n-gram to the
+        (sorted) indexes of the names containing it
+        """
+        postings = {}
+        for i, name in enumerate(self.names):
+            if name is not None:
+                for gram in self.get_grams(name):
+                    postings.setdefault(gram, []).append(i)
+
+        return {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+
+    def get_grams(self, text: str) -> set[str]:
+        """
+        Returns the distinct character n-grams
+        of a piece of text
+        """
+        return {text[i:i + self.gram_size] for i in range(len(text) - self.gram_size + 1)}
+
+    def get_candidates(self, query: str, threshold: float) -> np.ndarray:
+        """
+        Returns the indexes (in their original order)
+        of the names that could have a normalised
+        Levenshtein similarity of at least the
+        threshold with the query
+        """
+        # A similarity of t needs the lengths to be within a factor of t of each other
+        min_length = math.ceil(len(query) * threshold - 1e-9)
+        max_length = math.floor(len(query) / threshold + 1e-9)
+
+        mask = (self.lengths >= min_length) & (self.lengths <= max_length)
+
+        # Each edit removes at most gram_size of the query's n-grams, which bounds how many must be shared
+        max_edits = math.floor((1 - threshold) * max_length + 1e-9)
+        query_grams = self.get_grams(query)
+        min_shared_grams = len(query_grams) - max_edits * self.gram_size
+
+        if min_shared_grams > 0:
+            gram_postings = [self.postings[gram] for gram in query_grams if gram in self.postings]
+            if not gram_postings:
+                return np.empty(0, dtype=np.int64)
+
+            shared_grams = np.bincount(np.concatenate(gram_postings), minlength=len(self.names))
+            mask &= shared_grams >= min_shared_grams
+
+        return np.flatnonzero(mask)
+
+    def match(self, query: str, threshold: float) -> str:
+        """
+        Returns the most similar GRID name to the
+        query, or None if no name reaches the
+        similarity threshold
+        """
+        candidates = self.get_candidates(query, threshold)
+
+        if not len(candidates):
+            return None
+
+        result = extractOne(query, [self.names[i] for i in candidates],
+                            scorer=Levenshtein.normalized_similarity,
+                            score_cutoff=threshold)
+
+        return result[0] if result else None
+
+    def match_many(self, queries: list[str], threshold: float, workers: int = -1) -> list[str]:
+        """
+        Matches every query at once, scoring them
+        against all the GRID names with a single
+        (multi-core) cdist call per chunk of queries
+        """
+        valid_ids = np.flatnonzero(self.lengths >= 0)
+        valid_names = [self.names[i] for i in valid_ids]
+
+        matches = []
+
+        for i in range(0, len(queries), CDIST_CHUNK_SIZE):
+            scores = cdist(queries[i:i + CDIST_CHUNK_SIZE], valid_names,
+                           scorer=Levenshtein.normalized_similarity,
+                           score_cutoff=threshold, workers=workers, dtype=np.float64)
+
+            best = scores.argmax(axis=1)
+            best_scores = scores[np.arange(len(best)), best]
+
+            matches.extend(self.names[valid_ids[j]] if score >= threshold else None
+                           for j, score in zip(best, best_scores))
+
+        return matches
+
+
+def find_institution_segments(affiliations: list[str]) -> tuple[list[str], list[int]]:
+    """
+    Picks the comma-separated segment of each
+    affiliation containing the most preferred
+    institution keyword (the first such segment,
+    if there are several). Segments with digits
+    (street addresses) or too many words are not
+    trusted, and the indexes of those affiliations
+    are returned for spaCy to handle. Affiliations
+    without any keyword can't have a matching
+    entity, so are left as None
     """
     institutions_list = []
-    grid_institutions_list = []
+    fallback_indexes = []
 
-    target_keywords = {"university", "center", "centre", "laboratory", "hospital"}
+    for i, affiliation in enumerate(affiliations):
+        segments = [segment.strip(" .") for segment in re.split(r"[,;]", affiliation or "")]
+        keyword_segments = (segment for keyword in INSTITUTION_KEYWORDS for segment in segments if keyword in segment.lower())
+        institution = next(keyword_segments, None)
 
-    for doc in docs:
-        institutions_found = [ent.text for ent in doc.ents if ent.label_ == "ORG" and any(keyword in ent.text.lower() for keyword in target_keywords)]
-        if institutions_found:
-            institutions_list.append(institutions_found[0])
-            grid_institution_found = fuzzy_match(grid_institutions_df, institutions_found[0], 0.9)
-            grid_institutions_list.append(grid_institution_found)
-        else:
-            institutions_list.append(None)
-            grid_institutions_list.append(None)
-    
-    return institutions_list, grid_institutions_list
+        if institution and (any(character.isdigit() for character in institution)
+                            or len(institution.split()) > INSTITUTION_SEGMENT_MAX_WORDS):
+            fallback_indexes.append(i)
+
+        institutions_list.append(institution)
+
+    return institutions_list, fallback_indexes
+
+
+def find_institutions(affiliations: list[str], nlp: Language, config: dict) -> list[str]:
+    """
+    Attempts to extract the institution from each
+    author's 'affiliation' data, using the comma
+    segments where possible and otherwise the first
+    spaCy 'organisation' entity with an institution
+    keyword
+    """
+    with metrics.stage("institution_segments", len(affiliations)):
+        institutions_list, fallback_indexes = find_institution_segments(affiliations)
 
+    if fallback_indexes:
+        with metrics.stage("ner", len(fallback_indexes)):
+            entities = extract_entities(nlp, [affiliations[i] for i in fallback_indexes], config["NER_BATCH_SIZE"], config["NER_N_PROCESS"])
 
-def find_grid_id(row, grid_institutions_df: DataFrame):
+        for i, text_entities in zip(fallback_indexes, entities):
+            institutions_found = [text for text, label in text_entities if label == "ORG" and any(keyword in text.lower() for keyword in INSTITUTION_KEYWORDS)]
+            institutions_list[i] = institutions_found[0] if institutions_found else None
 
-    institution_name = row['grid_institutions']
-    if institution_name is not None and row['identity'] is None:
+    if affiliations:
+        logger.info("Institution spaCy fallback: %d of %d affiliations (%.1f%%)",
+                    len(fallback_indexes), len(affiliations), 100 * len(fallback_indexes) / len(affiliations))
 
-        result = grid_institutions_df.query(f"name=='{institution_name}'")["grid_id"]
+    return institutions_list
 
-        if not result.empty:
-            return str(result.iloc[0])
-        
-        return None
+
+def identify_institutions(institutions_list: list[str], grid_matcher: GridMatcher,
+                          batch_match: bool = False) -> list[str]:
+    """
+    Tries to match each institution to one from
+    the institutes.csv file (either one at a time,
+    or all unique institutions at once)
+    """
+    unique_institutions = list(dict.fromkeys(institution for institution in institutions_list if institution is not None))
+
+    if batch_match:
+        grid_matches = dict(zip(unique_institutions, grid_matcher.match_many(unique_institutions, 0.9)))
+    else:
+        grid_matches = {institution: fuzzy_match(grid_matcher, institution, 0.9) for institution in unique_institutions}
+
+    return [grid_matches.get(institution) for institution in institutions_list]
+
+
+class EnrichmentCache:
+    """
+    A SQLite file mapping the hash of each
+    normalised affiliation to its enrichment
+    results, so that they can be reused across
+    pipeline runs. The file is tied to a version
+    string (built from the spaCy model and the
+    data files) and is cleared if that changes
+    """
+
+    def __init__(self, db_path: str, version: str, max_entries: int):
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(db_path)
+
+        self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS enrichments
+                                   (affiliation_hash TEXT PRIMARY KEY, enrichment TEXT, last_used REAL)""")
+
+        stored_version = self.connection.execute("SELECT value FROM metadata WHERE key = 'version'").fetchone()
+
+        if stored_version is None or stored_version[0] != version:
+            self.connection.execute("DELETE FROM enrichments")
+            self.connection.execute("INSERT OR REPLACE INTO metadata VALUES ('version', ?)", (version,))
+
+        self.connection.commit()
+
+    def get_many(self, affiliations: list[str]) -> dict[str, dict]:
+        """
+        Returns the cached enrichments for any of
+        the given affiliations, marking them as used
+        """
+        hashes = {hash_affiliation(affiliation): affiliation for affiliation in affiliations}
+        hash_list = list(hashes)
+
+        found = {}
+
+        for i in range(0, len(hash_list), SQLITE_BATCH_SIZE):
+            batch = hash_list[i:i + SQLITE_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+
+            rows = self.connection.execute(
+                f"SELECT affiliation_hash, enrichment FROM enrichments WHERE affiliation_hash IN ({placeholders})",
+                batch)
+
+            for affiliation_hash, enrichment in rows:
+                found[hashes[affiliation_hash]] = json.loads(enrichment)
+
+        now = time.time()
+        self.connection.executemany("UPDATE enrichments SET last_used = ? WHERE affiliation_hash = ?",
+                                    [(now, hash_affiliation(affiliation)) for affiliation in found])
+        self.connection.commit()
+
+        return found
+
+    def put_many(self, enrichments: dict[str, dict]) -> None:
+        """
+        Stores the enrichments of the given
+        affiliations
+        """
+        now = time.time()
+        self.connection.executemany("INSERT OR REPLACE INTO enrichments VALUES (?, ?, ?)",
+                                    [(hash_affiliation(affiliation), json.dumps(enrichment), now)
+                                     for affiliation, enrichment in enrichments.items()])
+        self.connection.commit()
+
+    def evict(self) -> int:
+        """
+        Deletes the least recently used entries
+        beyond max_entries, returning how many
+        were removed
+        """
+        entry_count = self.connection.execute("SELECT COUNT(*) FROM enrichments").fetchone()[0]
+        excess = entry_count - self.max_entries
+
+        if excess <= 0:
+            return 0
+
+        self.connection.execute("""DELETE FROM enrichments WHERE affiliation_hash IN
+                                   (SELECT affiliation_hash FROM enrichments ORDER BY last_used LIMIT ?)""",
+                                (excess,))
+        self.connection.commit()
+        self.connection.execute("VACUUM")
+
+        return excess
+
+    def close(self) -> None:
+        """
+        Evicts any excess entries and closes
+        the database
+        """
+        evicted = self.evict()
+        if evicted:
+            logger.info("Evicted %d entries from the enrichment cache", evicted)
+
+        self.connection.close()
+
+
+def hash_affiliation(affiliation: str) -> str:
+    """
+    Returns the key an affiliation is stored
+    under in the enrichment cache
+    """
+    return hashlib.sha256(affiliation.encode()).hexdigest()
+
+
+def get_file_checksum(file_path: str) -> str:
+    """
+    Returns the MD5 checksum of a file's contents
+    """
+    checksum = hashlib.md5()
+
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+
+def get_enrichment_cache_version(nlp: Language, data_checksums: list[str]) -> str:
+    """
+    Builds the enrichment cache version from the
+    spaCy model and the checksums of the data used
+    to enrich affiliations (e.g. the GRID
+    institutes.csv), along with the country
+    variants, display names and place names, the
+    institution rules and the contact details
+    pattern
+    """
+    model_version = f"{nlp.meta['lang']}_{nlp.meta['name']}-{nlp.meta['version']}"
+    rules = [CONTACT_DETAILS_WITH_EMAIL_PATTERN.pattern, CHINA_PATTERN.pattern, COUNTRY_VARIANTS, COUNTRY_DISPLAY_NAMES,
+             SUBNATIONAL_NAMES, COUNTRY_FOLLOWING_WORDS, INSTITUTION_KEYWORDS, INSTITUTION_SEGMENT_MAX_WORDS]
+    rules_checksum = hashlib.md5(json.dumps(rules, sort_keys=True).encode()).hexdigest()
+
+    return "|".join([model_version] + data_checksums + [rules_checksum])
+
+
+def download_sqlite_file(s3: client, bucket_name: str, key: str, local_file_path: str) -> bool:
+    """
+    Downloads a SQLite file (the enrichment cache
+    or the article index) from S3, if it exists,
+    returning whether it was found
+    """
+    try:
+        with metrics.stage("sqlite_download"):
+            s3.download_file(bucket_name, key, local_file_path)
+    except ClientError as error:
+        if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return False
+        raise
+
+    return True
+
+
+def upload_sqlite_file(s3: client, bucket_name: str, key: str, local_file_path: str) -> None:
+    """
+    Uploads a SQLite file (the enrichment cache
+    or the article index) to S3, so that it can
+    be used by the next pipeline run
+    """
+    with metrics.stage("sqlite_upload"):
+        s3.upload_file(local_file_path, bucket_name, key)
+
+
+class ArticleIndex:
+    """
+    A SQLite file mapping each processed article's
+    pmid to its revision year, a hash of its
+    extracted rows and the output it was last
+    written to (each output is recorded by its
+    destination name and format). Articles that
+    are unchanged in a later dump are copied from
+    that output instead of being enriched again.
+    The least recently seen articles beyond
+    max_entries are evicted, and so are processed
+    again if they reappear. Like the enrichment
+    cache, it is cleared if its version changes
+    """
+
+    def __init__(self, db_path: str, version: str, max_entries: int):
+        self.max_entries = max_entries
+        self.output_id = None
+        self.output_format = None
+        self.seen_at = None
+        self.connection = sqlite3.connect(db_path)
+
+        version = f"{ARTICLE_INDEX_VERSION}|{version}"
+
+        self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+
+        stored_version = self.connection.execute("SELECT value FROM metadata WHERE key = 'version'").fetchone()
+
+        if stored_version is None or stored_version[0] != version:
+            self.connection.execute("DROP TABLE IF EXISTS articles")
+            self.connection.execute("DROP TABLE IF EXISTS outputs")
+            self.connection.execute("INSERT OR REPLACE INTO metadata VALUES ('version', ?)", (version,))
+
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS outputs
+                                   (output_id INTEGER PRIMARY KEY, destination_name TEXT, output_format TEXT)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS articles
+                                   (pmid TEXT PRIMARY KEY, revised TEXT, content_hash BLOB, output_id INTEGER, last_seen REAL)""")
+
+        # The unchanged articles of the output being written, with the earlier outputs they are copied from
+        self.connection.execute("CREATE TEMP TABLE unchanged (pmid TEXT PRIMARY KEY, output_id INTEGER)")
+
+        self.connection.commit()
+
+    def execute_batches(self, query: str, pmids: list[str], *params) -> Iterator[tuple]:
+        """
+        Runs a query once per batch of pmids (each
+        filling the query's {placeholders}, after any
+        other params), yielding the rows it returns
+        """
+        for i in range(0, len(pmids), SQLITE_BATCH_SIZE):
+            batch = pmids[i:i + SQLITE_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+
+            yield from self.connection.execute(query.format(placeholders=placeholders), [*params, *batch])
+
+    def start_output(self, destination_name: str, output_format: str) -> None:
+        """
+        Records a new output, which the articles
+        stored from now on are written to
+        """
+        self.output_id = self.connection.execute("INSERT INTO outputs (destination_name, output_format) VALUES (?, ?)",
+                                                 (destination_name, output_format)).lastrowid
+        self.output_format = output_format
+        self.seen_at = time.time()
+
+    def get_revisions(self, pmids: list[str]) -> dict[str, tuple[str, bytes]]:
+        """
+        Returns the (revision year, content hash) of
+        any of the given articles that can be copied
+        from an earlier output (of the same format)
+        """
+        return {pmid: (revised, content_hash) for pmid, revised, content_hash in self.execute_batches(
+            """SELECT pmid, revised, content_hash FROM articles JOIN outputs USING (output_id)
+               WHERE output_format = ? AND output_id != ? AND pmid IN ({placeholders})""",
+            pmids, self.output_format, self.output_id)}
+
+    def put_many(self, articles: dict[str, tuple[str, bytes]]) -> None:
+        """
+        Stores the revision year and content hash of
+        the given articles, as written to the
+        current output
+        """
+        self.connection.executemany("INSERT OR REPLACE INTO articles VALUES (?, ?, ?, ?, ?)",
+                                    [(pmid, revised, content_hash, self.output_id, self.seen_at)
+                                     for pmid, (revised, content_hash) in articles.items()])
+
+    def mark_unchanged(self, pmids: list[str]) -> None:
+        """
+        Marks the given (indexed) articles as seen,
+        to be copied from their earlier output
+        """
+        for i in range(0, len(pmids), SQLITE_BATCH_SIZE):
+            batch = pmids[i:i + SQLITE_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+
+            self.connection.execute(f"""INSERT OR REPLACE INTO unchanged
+                                        SELECT pmid, output_id FROM articles WHERE pmid IN ({placeholders})""", batch)
+            self.connection.execute(f"UPDATE articles SET last_seen = ? WHERE pmid IN ({placeholders})",
+                                    [self.seen_at, *batch])
+
+    def get_unchanged_outputs(self) -> list[tuple[int, str]]:
+        """
+        Returns the (id, destination name) of each
+        earlier output that unchanged articles are
+        copied from
+        """
+        return self.connection.execute("""SELECT DISTINCT output_id, destination_name
+                                          FROM unchanged JOIN outputs USING (output_id)""").fetchall()
+
+    def find_unchanged(self, output_id: int, pmids: list[str]) -> set[str]:
+        """
+        Returns which of the given articles are to
+        be copied from the given earlier output
+        """
+        return {pmid for pmid, in self.execute_batches(
+            "SELECT pmid FROM unchanged WHERE output_id = ? AND pmid IN ({placeholders})", pmids, output_id)}
+
+    def finish_output(self) -> None:
+        """
+        Records the copied articles as written to
+        the current output, evicts any excess
+        entries and the outputs no longer referred
+        to, and saves the changes
+        """
+        self.connection.execute("UPDATE articles SET output_id = ? WHERE pmid IN (SELECT pmid FROM unchanged)",
+                                (self.output_id,))
+        self.connection.execute("DELETE FROM unchanged")
+
+        entry_count = self.connection.execute("SELECT COUNT(*) FROM articles").fetchone()[0]
+        excess = entry_count - self.max_entries
+
+        if excess > 0:
+            self.connection.execute("""DELETE FROM articles WHERE pmid IN
+                                       (SELECT pmid FROM articles ORDER BY last_seen LIMIT ?)""", (excess,))
+            logger.info("Evicted %d entries from the article index", excess)
+
+        self.connection.execute("DELETE FROM outputs WHERE output_id NOT IN (SELECT DISTINCT output_id FROM articles)")
+        self.connection.commit()
+
+        if excess > 0:
+            self.connection.execute("VACUUM")
+
+    def abort_output(self) -> None:
+        """
+        Discards every change made since the current
+        output was started
+        """
+        self.connection.rollback()
+        self.connection.execute("DELETE FROM unchanged")
+        self.connection.commit()
+
+    def close(self) -> None:
+        """
+        Closes the database
+        """
+        self.connection.close()
+
+
+def hash_article_rows(rows: dict[str, list]) -> bytes:
+    """
+    Returns a (16 byte) hash of an article's
+    extracted rows (as columns), which changes if
+    anything that ends up in the article's output
+    changes
+    """
+    return hashlib.blake2b(json.dumps(rows, sort_keys=True).encode(), digest_size=16).digest()
+
+
+def normalise_affiliation(affiliation: str) -> str:
+    """
+    Collapses the whitespace in an affiliation
+    string, so that copies of the same affiliation
+    share a single key
+    """
+    return " ".join(affiliation.split()) if affiliation else ""
+
+
+def compute_enrichments(affiliations: list[str], nlp: Language, country_matcher: CountryMatcher,
+                        grid_matcher: GridMatcher, config: dict) -> dict[str, dict]:
+    """
+    Finds the contact details, country and
+    institution of each of the given (unique)
+    affiliations, returning a dictionary of the
+    results keyed by affiliation
+    """
+    unique_df = DataFrame({"affiliation": pd.Series(affiliations, dtype=object)})
+
+    with metrics.stage("contact_details", len(affiliations)):
+        unique_df = find_contact_details(unique_df)
+
+    with metrics.stage("countries", len(affiliations)):
+        unique_df['country'] = identify_countries(affiliations, country_matcher)
+
+    institutions_list = find_institutions(affiliations, nlp, config)
+
+    unique_df['institutions'] = institutions_list
+
+    with metrics.stage("grid_matching", len(institutions_list)):
+        unique_df['grid_institutions'] = identify_institutions(institutions_list, grid_matcher, config["GRID_MATCH_MODE"] == "batch")
+
+    enrichments = unique_df.set_index("affiliation")[ENRICHMENT_COLUMNS].astype(object)
+    enrichments = enrichments.where(enrichments.notna(), None)
+
+    return enrichments.to_dict("index")
+
+
+def encode_enrichment_column(column: str, unique_values: list, codes: np.ndarray) -> pd.Categorical | np.ndarray:
+    """
+    Builds an enrichment column from the value of
+    each unique affiliation and each row's unique
+    affiliation code, as a categorical for the
+    CATEGORICAL_COLUMNS
+    """
+    if column in CATEGORICAL_COLUMNS:
+        value_codes, categories = pd.factorize(pd.Series(unique_values, dtype=object))
+        return pd.Categorical.from_codes(value_codes[codes], categories)
+
+    values = np.empty(len(unique_values), dtype=object)
+    values[:] = unique_values
+
+    return values[codes]
+
+
+def encode_categorical_columns(df: DataFrame) -> DataFrame:
+    """
+    Converts any of the CATEGORICAL_COLUMNS that
+    aren't yet categoricals
+    """
+    for column in CATEGORICAL_COLUMNS:
+        if column in df and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype("category")
+
+    return df
+
+
+def enrich_affiliations(df: DataFrame, nlp: Language, country_matcher: CountryMatcher,
+                        grid_matcher: GridMatcher, config: dict,
+                        cache: EnrichmentCache = None) -> DataFrame:
+    """
+    Adds the contact details, country and
+    institution columns to the data. Each unique
+    affiliation is only processed once (or not at
+    all, if it is in the enrichment cache), and the
+    results are then copied to every row sharing
+    that affiliation (as codes, for the categorical
+    columns)
+    """
+    affiliation_keys = df['affiliation'].map(normalise_affiliation)
+
+    codes, unique_keys = pd.factorize(affiliation_keys)
+    unique_keys = unique_keys.tolist()
+
+    if len(df):
+        logger.info("Affiliation dedupe hit rate: %.1f%% (%d unique of %d)",
+                    100 * (1 - len(unique_keys) / len(df)), len(unique_keys), len(df))
+
+    with metrics.stage("enrichment_cache"):
+        enrichments = cache.get_many(unique_keys) if cache is not None else {}
+
+    missing_keys = [key for key in unique_keys if key not in enrichments]
+
+    if cache is not None:
+        logger.info("Enrichment cache hits: %d of %d unique affiliations", len(enrichments), len(unique_keys))
+
+    if missing_keys:
+        new_enrichments = compute_enrichments(missing_keys, nlp, country_matcher, grid_matcher, config)
+
+        if cache is not None:
+            with metrics.stage("enrichment_cache"):
+                cache.put_many(new_enrichments)
+
+        enrichments.update(new_enrichments)
+
+    for column in ENRICHMENT_COLUMNS:
+        df[column] = encode_enrichment_column(column, [enrichments[key][column] for key in unique_keys], codes)
+
+    return df
+
+
+def build_grid_id_index(names: pd.Series, grid_ids: pd.Series) -> dict[str, str]:
+    """
+    Builds a dictionary mapping each institution
+    name (or alias) to its GRID ID, keeping the
+    first GRID ID if a name appears more than once
+    """
+    lookup = DataFrame({"name": names, "grid_id": grid_ids}).dropna().drop_duplicates("name")
+
+    return dict(zip(lookup["name"], lookup["grid_id"].astype(str)))
+
+
+def find_grid_ids(df: DataFrame, name_index: dict[str, str], alias_index: dict[str, str]) -> pd.Series:
+    """
+    Attempts to find each row's institution's
+    GRID ID, first by its matched institutes.csv
+    name and then by treating the extracted name
+    as an alias from aliases.csv. GRID IDs already
+    given in the PubMed data are kept
+    """
+    # On the categorical columns, map only looks up each distinct name once. Mapping with .get avoids
+    # pandas converting the whole (large) index dictionary into a Series on every call
+    resolved = df['grid_institutions'].map(name_index.get).astype(object)
+    resolved = resolved.where(resolved.notna(), df['institutions'].map(alias_index.get).astype(object))
+
+    identity = df['identity'].where(df['identity'].notna(), resolved).astype(object)
+
+    return identity.where(identity.notna(), None)
+
+
+def load_grid_data_from_csv(grid_dir: str) -> dict:
+    """
+    Loads the GRID institutes and aliases from
+    their .csv files, returning the fuzzy matcher
+    and the name and alias GRID ID indexes built
+    from them
+    """
+    institutes_file_path = os.path.join(grid_dir, "institutes.csv")
+
+    grid_institutions_df = pd.read_csv(institutes_file_path, usecols=["grid_id", "name"])
+    aliases_df = pd.read_csv(os.path.join(grid_dir, "aliases.csv"), usecols=["grid_id", "alias"])
+
+    return {
+        "matcher": GridMatcher(grid_institutions_df['name'].tolist()),
+        "name_index": build_grid_id_index(grid_institutions_df['name'], grid_institutions_df['grid_id']),
+        "alias_index": build_grid_id_index(aliases_df['alias'], aliases_df['grid_id']),
+        "institutes_checksum": get_file_checksum(institutes_file_path)
+    }
+
+
+def get_grid_source_file_stats(grid_dir: str) -> dict:
+    """
+    Returns the size and modification time of each
+    GRID .csv file, or None if any of them are
+    missing (as in the Lambda image, which only
+    ships the snapshot)
+    """
+    stats = {}
+
+    for file_name in GRID_SOURCE_FILE_NAMES:
+        file_path = os.path.join(grid_dir, file_name)
+
+        if not os.path.exists(file_path):
+            return None
+
+        stat = os.stat(file_path)
+        stats[file_name] = [stat.st_size, stat.st_mtime_ns]
+
+    return stats
+
+
+def write_arrow_table(file_path: str, table: pa.Table) -> None:
+    """
+    Writes a table to an (uncompressed) Arrow IPC
+    file, as a single record batch
+    """
+    with pa.OSFile(file_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table.combine_chunks())
+
+
+def read_arrow_table(file_path: str, columns: list[str]) -> pa.Table:
+    """
+    Memory-maps an Arrow IPC file and returns the
+    given columns. Nothing is copied, so only the
+    pages of the columns that are used get read
+    """
+    return pa.ipc.open_file(pa.memory_map(file_path)).read_all().select(columns)
+
+
+def build_grid_snapshot(grid_dir: str) -> str:
+    """
+    Converts the GRID .csv files into a columnar
+    snapshot (a folder of Arrow files), with the
+    lookup indexes and the fuzzy matcher's n-gram
+    index already built, returning the snapshot's
+    folder path
+    """
+    grid_data = load_grid_data_from_csv(grid_dir)
+    matcher = grid_data["matcher"]
+
+    # The postings are stored as one list column, whose offsets and values are sliced back apart when loaded
+    grams = list(matcher.postings)
+    gram_ids = [matcher.postings[gram] for gram in grams]
+    offsets = np.concatenate([[0], np.cumsum([len(ids) for ids in gram_ids], dtype=np.int64)]).astype(np.int32)
+    values = np.concatenate(gram_ids).astype(np.int32) if gram_ids else np.empty(0, dtype=np.int32)
+
+    tables = {
+        "names": pa.table({"name": pa.array(matcher.names, pa.string())}),
+        "postings": pa.table({"gram": pa.array(grams, pa.string()),
+                              "ids": pa.ListArray.from_arrays(pa.array(offsets), pa.array(values))}),
+        "name_index": pa.table({"name": pa.array(list(grid_data["name_index"]), pa.string()),
+                                "grid_id": pa.array(list(grid_data["name_index"].values()), pa.string())}),
+        "alias_index": pa.table({"name": pa.array(list(grid_data["alias_index"]), pa.string()),
+                                 "grid_id": pa.array(list(grid_data["alias_index"].values()), pa.string())})
+    }
+
+    snapshot_dir = os.path.join(grid_dir, GRID_SNAPSHOT_DIR_NAME)
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    for table_name, table in tables.items():
+        write_arrow_table(os.path.join(snapshot_dir, f"{table_name}.arrow"), table)
+
+    # Written last, so that a partly written snapshot is never loaded
+    metadata = {
+        "version": GRID_SNAPSHOT_VERSION,
+        "gram_size": matcher.gram_size,
+        "institutes_checksum": grid_data["institutes_checksum"],
+        "source_files": get_grid_source_file_stats(grid_dir)
+    }
+
+    with open(os.path.join(snapshot_dir, "metadata.json"), "w") as f:
+        json.dump(metadata, f)
+
+    return snapshot_dir
+
+
+def load_grid_snapshot(snapshot_dir: str, metadata: dict) -> dict:
+    """
+    Loads the GRID data from the memory-mapped
+    Arrow files of a snapshot. The n-gram postings
+    are views into the mapped file, rather than
+    copies of it
+    """
+    names = read_arrow_table(os.path.join(snapshot_dir, "names.arrow"), ["name"])["name"].to_pylist()
+
+    postings_table = read_arrow_table(os.path.join(snapshot_dir, "postings.arrow"), ["gram", "ids"])
+    gram_ids = postings_table["ids"].combine_chunks()
+    values = gram_ids.values.to_numpy(zero_copy_only=True)
+    offsets = gram_ids.offsets.to_numpy()
+
+    postings = {gram: values[start:end]
+                for gram, start, end in zip(postings_table["gram"].to_pylist(), offsets[:-1], offsets[1:])}
+
+    indexes = {}
+    for index_name in ("name_index", "alias_index"):
+        index_table = read_arrow_table(os.path.join(snapshot_dir, f"{index_name}.arrow"), ["name", "grid_id"])
+        indexes[index_name] = dict(zip(index_table["name"].to_pylist(), index_table["grid_id"].to_pylist()))
+
+    return {
+        "matcher": GridMatcher(names, metadata["gram_size"], postings),
+        "name_index": indexes["name_index"],
+        "alias_index": indexes["alias_index"],
+        "institutes_checksum": metadata["institutes_checksum"]
+    }
+
+
+def load_grid_data(grid_dir: str) -> dict:
+    """
+    Loads the GRID data from its snapshot if one
+    has been built (see build_grid_snapshot),
+    otherwise from the GRID .csv files. A snapshot
+    is ignored if the .csv files next to it have
+    changed since it was built
+    """
+    snapshot_dir = os.path.join(grid_dir, GRID_SNAPSHOT_DIR_NAME)
+    metadata_file_path = os.path.join(snapshot_dir, "metadata.json")
+
+    if os.path.exists(metadata_file_path):
+
+        with open(metadata_file_path) as f:
+            metadata = json.load(f)
+
+        source_file_stats = get_grid_source_file_stats(grid_dir)
+
+        if metadata["version"] != GRID_SNAPSHOT_VERSION:
+            logger.warning("Ignoring GRID snapshot %s built with an old format", snapshot_dir)
+        elif source_file_stats is not None and source_file_stats != metadata["source_files"]:
+            logger.warning("Ignoring GRID snapshot %s, as the GRID .csv files have changed since it was built",
+                           snapshot_dir)
+        else:
+            return load_grid_snapshot(snapshot_dir, metadata)
+
+    return load_grid_data_from_csv(grid_dir)
 
 
 def get_world_countries_list(file_path : str) -> list[str]:
@@ -225,19 +1798,508 @@ def add_column_to_data(column_values_list : list, column_name: str, df: DataFram
     df.to_csv(file_path, index=False)
 
 
-def fuzzy_match(grid_institutions_df: DataFrame, found_institute: str, threshold: float) -> str:
+def fuzzy_match(grid_matcher: GridMatcher, found_institute: str, threshold: float) -> str:
     """
     Attempts to match a given institution name
     to one found in the institutes.csv file
     """
-    grid_institution = extractOne(found_institute, grid_institutions_df['name'],
-                                  scorer=Levenshtein.normalized_similarity,
-                                  score_cutoff=threshold)
+    return grid_matcher.match(found_institute, threshold)
 
-    if grid_institution:
-        return grid_institution[0]
-    
-    return None
+
+def get_article_chunks(articles: Iterable[dict], chunk_size: int) -> Iterator[list[dict]]:
+    """
+    Groups a stream of articles into lists of
+    (at most) chunk_size articles
+    """
+    articles = iter(articles)
+
+    while chunk := list(islice(articles, chunk_size)):
+        yield chunk
+
+
+def flatten_article_chunks(articles: Iterable[dict], chunk_size: int) -> Iterator[dict[str, list]]:
+    """
+    Yields the flattened rows of each chunk of
+    chunk_size articles. Parsing is measured once
+    per chunk rather than per article, as each
+    stage call reads and resets the peak RSS
+    """
+    for chunk in metrics.iterate("parse", get_article_chunks(articles, chunk_size), len):
+        with metrics.stage("flatten"):
+            rows = flatten_article_data(chunk)
+
+        metrics.add_rows("flatten", len(rows["pmid"]))
+
+        yield rows
+
+
+def process_rows(rows: dict[str, list], resources: dict, config: dict, cache: EnrichmentCache) -> DataFrame:
+    """
+    Turns a chunk of flattened rows (as columns)
+    into a DataFrame (with the repeated columns
+    as categoricals), then enriches the
+    affiliations and finds the GRID IDs
+    """
+    with metrics.stage("build_dataframe", len(rows["pmid"])):
+        df = encode_categorical_columns(pd.DataFrame(rows))
+
+    if df.empty:
+        return df
+
+    grid_data = resources["grid_data"]
+
+    with metrics.stage("enrich_affiliations", len(df)):
+        df = enrich_affiliations(df, resources["nlp"], resources["country_matcher"], grid_data["matcher"], config, cache)
+
+    with metrics.stage("find_grid_ids", len(df)):
+        df['identity'] = find_grid_ids(df, grid_data["name_index"], grid_data["alias_index"])
+
+    return df
+
+
+def process_rows_incrementally(rows: dict[str, list], resources: dict, config: dict, cache: EnrichmentCache,
+                               article_index: ArticleIndex) -> DataFrame:
+    """
+    Processes only the rows of articles that are
+    new or revised since they were last indexed,
+    storing their revisions in the index. The
+    unchanged articles are marked in the index, to
+    be copied from the earlier output they were
+    written to once every chunk is processed
+    """
+    article_row_indexes = {}
+    for i, pmid in enumerate(rows['pmid']):
+        article_row_indexes.setdefault(pmid, []).append(i)
+
+    revisions = {pmid: (rows['year'][indexes[0]], hash_article_rows(select_rows(rows, indexes)))
+                 for pmid, indexes in article_row_indexes.items()}
+
+    indexed_revisions = article_index.get_revisions([pmid for pmid in article_row_indexes if pmid is not None])
+
+    changed_pmids = [pmid for pmid in article_row_indexes if pmid is None or indexed_revisions.get(pmid) != revisions[pmid]]
+    changed_pmid_set = set(changed_pmids)
+
+    if article_row_indexes:
+        logger.info("Incremental processing: %d of %d articles new or revised", len(changed_pmids), len(article_row_indexes))
+
+    article_index.mark_unchanged([pmid for pmid in article_row_indexes if pmid not in changed_pmid_set])
+    article_index.put_many({pmid: revisions[pmid] for pmid in changed_pmids if pmid is not None})
+
+    return process_rows(select_rows(rows, [i for pmid in changed_pmids for i in article_row_indexes[pmid]]),
+                        resources, config, cache)
+
+
+class S3ObjectReader(io.RawIOBase):
+    """
+    A seekable file object over an S3 object, which
+    fetches the bytes of each read with a ranged
+    GET. This lets formats that need random access
+    (such as Parquet, whose footer is read first) be
+    read without downloading the whole object
+    """
+
+    def __init__(self, s3: client, bucket_name: str, key: str):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = s3.head_object(Bucket=bucket_name, Key=key)["ContentLength"]
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self.position = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence] + offset
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        """
+        Fills the buffer with the bytes from the
+        current position, in a single ranged GET
+        """
+        end = min(self.position + len(buffer), self.size)
+
+        if end <= self.position:
+            return 0
+
+        with self.s3.get_object(Bucket=self.bucket_name, Key=self.key,
+                                Range=f"bytes={self.position}-{end - 1}")["Body"] as body:
+            data = body.read()
+
+        buffer[:len(data)] = data
+        self.position += len(data)
+
+        return len(data)
+
+
+def get_s3_input_opener(s3: client, bucket_name: str, destination_name: str):
+    """
+    Returns a function that opens the S3 key formed
+    from the destination name plus a given suffix
+    for (buffered, seekable) reading, e.g. to read
+    back an earlier output
+    """
+    return lambda suffix: io.BufferedReader(S3ObjectReader(s3, bucket_name, f"{destination_name}{suffix}"),
+                                            buffer_size=S3_READ_CHUNK_SIZE)
+
+
+class S3MultipartUpload:
+    """
+    A writable file-like object that streams its
+    contents to an S3 object. Every S3_PART_SIZE
+    bytes are uploaded as a part of a multipart
+    upload by a background thread pool, so the
+    upload overlaps with whatever is producing the
+    data. Output smaller than one part is sent with
+    a single put_object call instead
+    """
+
+    def __init__(self, s3: client, bucket_name: str, key: str):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.name = f"s3://{bucket_name}/{key}"
+        self.closed = False
+
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.part_uploads = deque()
+        self.parts = []
+        self.executor = ThreadPoolExecutor(max_workers=S3_UPLOAD_CONCURRENCY)
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def write(self, data: bytes) -> int:
+        """
+        Buffers the data, sending off a part each
+        time a full part's worth has been written
+        """
+        self.buffer += data
+        self.position += len(data)
+
+        while len(self.buffer) >= S3_PART_SIZE:
+            self.upload_part(bytes(self.buffer[:S3_PART_SIZE]))
+            del self.buffer[:S3_PART_SIZE]
+
+        return len(data)
+
+    def upload_part(self, part: bytes) -> None:
+        """
+        Starts uploading a part in the background,
+        waiting for older parts first if too many
+        are already in flight
+        """
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket_name, Key=self.key)["UploadId"]
+
+        part_number = len(self.parts) + len(self.part_uploads) + 1
+
+        self.part_uploads.append((part_number, self.executor.submit(
+            self.s3.upload_part, Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=part)))
+
+        while len(self.part_uploads) > S3_UPLOAD_CONCURRENCY:
+            self.finish_oldest_part()
+
+    def finish_oldest_part(self) -> None:
+        """
+        Waits for the oldest in-flight part to
+        finish uploading
+        """
+        part_number, part_upload = self.part_uploads.popleft()
+        self.parts.append({"PartNumber": part_number, "ETag": part_upload.result()["ETag"]})
+
+    def close(self) -> None:
+        """
+        Uploads whatever is left in the buffer and
+        completes the upload
+        """
+        if self.closed:
+            return
+
+        try:
+            if self.upload_id is None:
+                self.s3.put_object(Bucket=self.bucket_name, Key=self.key, Body=bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self.upload_part(bytes(self.buffer))
+                while self.part_uploads:
+                    self.finish_oldest_part()
+
+                self.s3.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={"Parts": self.parts})
+        except Exception:
+            self.abort()
+            raise
+
+        self.closed = True
+        self.executor.shutdown()
+
+    def abort(self) -> None:
+        """
+        Abandons the upload, so that no (partial)
+        object is created
+        """
+        self.closed = True
+        self.executor.shutdown(cancel_futures=True)
+
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+
+
+def get_s3_output_opener(s3: client, bucket_name: str, destination_name: str):
+    """
+    Returns a function that opens a streaming
+    upload to the S3 key formed from the
+    destination name plus a given suffix (such
+    as '.csv' or '/articles.parquet')
+    """
+    return lambda suffix: S3MultipartUpload(s3, bucket_name, f"{destination_name}{suffix}")
+
+
+class CsvOutputWriter:
+    """
+    Appends each processed chunk of rows to a
+    single flat .csv file
+    """
+
+    def __init__(self, open_output):
+        self.outputs = [open_output(".csv")]
+        self.row_count = 0
+
+    def write(self, df: DataFrame) -> None:
+        """
+        Appends a chunk of rows to the .csv file
+        """
+        if df.empty:
+            return
+
+        csv_text = df.drop(columns=ROW_KEY_COLUMNS).to_csv(header=self.row_count == 0, index=False)
+        self.outputs[0].write(csv_text.encode("utf-8"))
+        self.row_count += len(df)
+
+    def copy_rows(self, open_previous, find_pmids) -> None:
+        """
+        Appends the rows of some of the articles in
+        an earlier .csv output (opened with
+        open_previous), as they were written. For
+        each batch of rows, find_pmids picks the
+        pmids to copy
+        """
+        with open_previous(".csv") as previous:
+            for batch in pd.read_csv(previous, dtype=str, keep_default_na=False, chunksize=PREVIOUS_OUTPUT_BATCH_ROWS):
+                batch = batch[batch['pmid'].isin(find_pmids(batch['pmid'].unique().tolist()))]
+
+                if not batch.empty:
+                    self.outputs[0].write(batch.to_csv(header=self.row_count == 0, index=False).encode("utf-8"))
+                    self.row_count += len(batch)
+
+    def close(self) -> None:
+        """
+        Closes the .csv file
+        """
+        self.outputs[0].close()
+
+    def abort(self) -> None:
+        """
+        Abandons the .csv file
+        """
+        self.outputs[0].abort()
+
+
+class ParquetOutputWriter:
+    """
+    Splits each processed chunk of rows into
+    normalised article, author and affiliation
+    tables (keyed by pmid, author index and
+    affiliation index), and appends them to one
+    compressed Parquet file per table
+    """
+
+    def __init__(self, open_output):
+        self.outputs = [open_output(f"/{table_name}.parquet") for table_name in PARQUET_TABLES]
+        self.writers = {table_name: pq.ParquetWriter(output, PARQUET_TABLES[table_name]["schema"],
+                                                     compression=PARQUET_COMPRESSION)
+                        for table_name, output in zip(PARQUET_TABLES, self.outputs)}
+        self.row_count = 0
+
+    def write(self, df: DataFrame) -> None:
+        """
+        Appends a chunk of rows to the Parquet
+        tables, keeping one row per article, author
+        and affiliation
+        """
+        if df.empty:
+            return
+
+        for table_name, table in PARQUET_TABLES.items():
+            table_df = df[table["schema"].names].drop_duplicates(subset=table["keys"])
+            self.writers[table_name].write_table(pa.Table.from_pandas(table_df, schema=table["schema"], preserve_index=False))
+
+        self.row_count += len(df)
+
+    def copy_rows(self, open_previous, find_pmids) -> None:
+        """
+        Appends the rows of some of the articles in
+        earlier Parquet outputs (opened with
+        open_previous) to each table. For each batch
+        of rows, find_pmids picks the pmids to copy
+        """
+        for table_name, table in PARQUET_TABLES.items():
+            with open_previous(f"/{table_name}.parquet") as previous:
+                for batch in pq.ParquetFile(previous).iter_batches(batch_size=PREVIOUS_OUTPUT_BATCH_ROWS):
+                    pmids = batch.column("pmid")
+                    keep = find_pmids(pc.unique(pmids).drop_null().to_pylist())
+                    batch = batch.filter(pc.is_in(pmids, value_set=pa.array(list(keep), pa.string())))
+
+                    if batch.num_rows:
+                        self.writers[table_name].write_table(pa.Table.from_batches([batch]).cast(table["schema"]))
+
+                    # Each affiliation is one row of the flat output
+                    if table_name == "affiliations":
+                        self.row_count += batch.num_rows
+
+    def close(self) -> None:
+        """
+        Finishes and closes the Parquet files
+        """
+        for writer, output in zip(self.writers.values(), self.outputs):
+            writer.close()
+            output.close()
+
+    def abort(self) -> None:
+        """
+        Abandons the Parquet files
+        """
+        for output in self.outputs:
+            output.abort()
+
+
+def create_output_writer(output_format: str, open_output):
+    """
+    Returns the writer for the chosen output format
+    ('csv' or 'parquet'), which uses open_output to
+    open each of its output files
+    """
+    if output_format == "parquet":
+        return ParquetOutputWriter(open_output)
+
+    if output_format == "csv":
+        return CsvOutputWriter(open_output)
+
+    raise ValueError(f"Unknown output format: {output_format}")
+
+
+def run_pipeline(row_chunks: Iterable[dict[str, list]], resources: dict, config: dict,
+                 cache: EnrichmentCache, writer, article_index: ArticleIndex = None,
+                 output_s3: client = None, destination_name: str = None) -> int:
+    """
+    Processes the flattened rows one chunk at a
+    time and passes each chunk to the output writer,
+    so only one chunk is held in memory at once.
+    Given an article index, only new or revised
+    articles are processed, and the rows of the
+    unchanged ones are then copied from the earlier
+    outputs (in output_s3's output bucket) they
+    were written to, so that the output (under
+    destination_name) covers every article. Returns
+    the number of rows written
+    """
+    if article_index is not None:
+        article_index.start_output(destination_name, config["OUTPUT_FORMAT"])
+
+    try:
+        for rows in metrics.iterate("extract", row_chunks, lambda rows: len(rows["pmid"])):
+            if article_index is not None:
+                with metrics.stage("incremental", len(rows["pmid"])):
+                    df = process_rows_incrementally(rows, resources, config, cache, article_index)
+            else:
+                df = process_rows(rows, resources, config, cache)
+
+            with metrics.stage("write", len(df)):
+                writer.write(df)
+
+        if article_index is not None:
+            for output_id, previous_destination_name in article_index.get_unchanged_outputs():
+                row_count = writer.row_count
+
+                with metrics.stage("copy_unchanged"):
+                    writer.copy_rows(get_s3_input_opener(output_s3, config["OUTPUT_BUCKET_NAME"], previous_destination_name),
+                                     lambda pmids: article_index.find_unchanged(output_id, pmids))
+
+                metrics.add_rows("copy_unchanged", writer.row_count - row_count)
+    except BaseException:
+        writer.abort()
+        if article_index is not None:
+            article_index.abort_output()
+        raise
+
+    try:
+        with metrics.stage("finish_output"):
+            writer.close()
+    except BaseException:
+        if article_index is not None:
+            article_index.abort_output()
+        raise
+
+    if article_index is not None:
+        article_index.finish_output()
+
+    logger.info("Wrote %d rows to %s", writer.row_count, ", ".join(output.name for output in writer.outputs))
+
+    return writer.row_count
+
+
+def run_batch_ingestion(s3: client, output_s3: client, resources: dict, config: dict, cache: EnrichmentCache,
+                        destination_name: str, extract_row_chunks, article_index: ArticleIndex = None) -> list[str]:
+    """
+    Runs every PubMed file under the input prefix
+    that isn't yet in the manifest through the
+    pipeline, giving each its own output. Each file
+    is streamed from S3 as it is parsed, and the
+    manifest is saved after each file, so a rerun
+    picks up where this one stopped. Returns the
+    keys processed
+    """
+    manifest = download_manifest(output_s3, config["OUTPUT_BUCKET_NAME"], config["INGEST_MANIFEST_KEY"])
+
+    pubmed_objects = find_unprocessed_pubmed_objects(
+        list_pubmed_objects(s3, config["INPUT_BUCKET_NAME"], config["INPUT_BUCKET_PREFIX"]), manifest)
+
+    logger.info("Batch ingestion: %d unprocessed PubMed files", len(pubmed_objects))
+
+    processed_keys = []
+
+    pubmed_sources = iter_streamed_pubmed_files(s3, config["INPUT_BUCKET_NAME"], pubmed_objects)
+
+    for obj, pubmed_xml_source in metrics.iterate("download", pubmed_sources):
+
+        output_name = f"{destination_name}_{get_pubmed_file_stem(obj['Key'])}"
+
+        writer = create_output_writer(config["OUTPUT_FORMAT"], get_s3_output_opener(output_s3, config["OUTPUT_BUCKET_NAME"], output_name))
+        run_pipeline(extract_row_chunks(pubmed_xml_source), resources, config, cache, writer, article_index,
+                     output_s3, output_name)
+
+        manifest[obj['Key']] = {"etag": obj['ETag'], "output": output_name, "processed_at": get_timestamp()}
+        upload_manifest(output_s3, config["OUTPUT_BUCKET_NAME"], config["INGEST_MANIFEST_KEY"], manifest)
+
+        processed_keys.append(obj['Key'])
+
+    return processed_keys
 
 
 def get_timestamp() -> str:
@@ -250,12 +2312,56 @@ def get_timestamp() -> str:
     return timestamp_str
 
 
+def get_resource(name: str, loader) -> object:
+    """
+    Returns a resource that is loaded once per
+    Lambda container (by calling the loader the
+    first time it is needed) and then reused by
+    every warm invocation
+    """
+    if name not in RESOURCES:
+        RESOURCES[name] = loader()
+
+    return RESOURCES[name]
+
+
+def load_resources(config: dict) -> dict:
+    """
+    Fetches the clients, model and data files the
+    pipeline needs, logging whether this is a cold
+    start (and how long loading took)
+    """
+    cold_start = not RESOURCES
+    start = time.perf_counter()
+
+    resources = {
+        "s3": get_resource("s3", lambda: client("s3", aws_access_key_id=config["ACCESS_KEY_ID"],
+                                                aws_secret_access_key=config["SECRET_ACCESS_KEY"])),
+        "sns": get_resource("sns", lambda: client("sns")),
+        "nlp": get_resource("nlp", load_ner_model),
+        "country_matcher": get_resource("country_matcher", lambda: CountryMatcher(get_world_countries_list("./world_countries.txt"))),
+        "grid_data": get_resource("grid_data", lambda: load_grid_data("/GRID_Data"))
+    }
+
+    resources["enrichment_cache_version"] = get_resource(
+        "enrichment_cache_version",
+        lambda: get_enrichment_cache_version(resources["nlp"], [resources["grid_data"]["institutes_checksum"],
+                                                                get_file_checksum("./world_countries.txt")]))
+
+    logger.info("%s start: resources ready in %.3fs", "Cold" if cold_start else "Warm", time.perf_counter() - start)
+
+    return resources
+
+
 def lambda_handler(event, context) -> dict:
     """
     This section of code is the 'Lambda function',
     to be used by AWS Lambda to execute the 
-    data processing pipeline
+    data processing pipeline. The response body
+    includes the run's stage metrics
     """
+    metrics.reset()
+
     load_dotenv()
 
     config = {}
@@ -266,76 +2372,108 @@ def lambda_handler(event, context) -> dict:
     config["INPUT_BUCKET_NAME"] = environ.get("INPUT_BUCKET_NAME")
     config["OUTPUT_BUCKET_NAME"] = environ.get("OUTPUT_BUCKET_NAME")
 
-    config["INPUT_BUCKET_PREFIX"] = environ.get("INPUT_BUCKET_PREFIX")
+    config["INPUT_BUCKET_PREFIX"] = environ.get("INPUT_BUCKET_PREFIX", "Annie/")
     config["INPUT_BUCKET_GRID_PREFIX"] = environ.get("INPUT_BUCKET_GRID_PREFIX")
     config["OUTPUT_BUCKET_PREFIX"] = environ.get("OUTPUT_BUCKET_PREFIX")
 
-    s3 = client("s3", aws_access_key_id=config["ACCESS_KEY_ID"],
-                aws_secret_access_key=config["SECRET_ACCESS_KEY"])
-    
-    sns = client("sns")
-    
+    # Lambda has no /dev/shm, so spaCy's multiprocessing is off unless configured
+    config["NER_BATCH_SIZE"] = int(environ.get("NER_BATCH_SIZE", 256))
+    config["NER_N_PROCESS"] = int(environ.get("NER_N_PROCESS", 1))
+
+    # Where the enrichment cache is kept between runs, and how many affiliations it may hold
+    config["ENRICHMENT_CACHE_KEY"] = environ.get("ENRICHMENT_CACHE_KEY", "enrichment_cache.sqlite")
+    # How many articles are processed (and held in memory) at once
+    config["ARTICLE_CHUNK_SIZE"] = int(environ.get("ARTICLE_CHUNK_SIZE", 1000))
+
+    # Either one flat .csv file ("csv") or normalised Parquet tables ("parquet")
+    config["OUTPUT_FORMAT"] = environ.get("OUTPUT_FORMAT", "csv")
+
+    config["ENRICHMENT_CACHE_MAX_ENTRIES"] = int(environ.get("ENRICHMENT_CACHE_MAX_ENTRIES", 500000))
+
+    # "latest" processes the most recent PubMed file, "batch" every file not yet in the manifest
+    config["INGEST_MODE"] = environ.get("INGEST_MODE", "latest")
+    config["INGEST_MANIFEST_KEY"] = environ.get("INGEST_MANIFEST_KEY", "ingestion_manifest.json")
+
+    # Only enrich new or revised articles, reusing the indexed results of unchanged ones
+    config["INCREMENTAL"] = environ.get("INCREMENTAL", "false").lower() == "true"
+    config["ARTICLE_INDEX_KEY"] = environ.get("ARTICLE_INDEX_KEY", "article_index.sqlite")
+    config["ARTICLE_INDEX_MAX_ENTRIES"] = int(environ.get("ARTICLE_INDEX_MAX_ENTRIES", 1000000))
+
+    # Lambda has few cores, so the indexed matcher is usually faster than batch cdist here
+    config["GRID_MATCH_MODE"] = environ.get("GRID_MATCH_MODE", "indexed")
+
+    with metrics.stage("load_resources"):
+        resources = load_resources(config)
+
+    s3 = resources["s3"]
+
+    sns = resources["sns"]
+
     current_timestamp_str = get_timestamp()
     
-    grid_institutions_df = pd.read_csv("/GRID_Data/institutes.csv")
-    aliases_df = pd.read_csv("/GRID_Data/aliases.csv")
-    addresses_df = pd.read_csv("/GRID_Data/addresses.csv")
-    
-    pubmed_xml_file_path = '/tmp/pubmed_xml_file.xml'
-    processed_csv_file_path = '/tmp/processed_article_data.csv'
-    processed_csv_destination_key = f'{config["OUTPUT_BUCKET_PREFIX"]}processed_article_data_{current_timestamp_str}.csv'
+    enrichment_cache_file_path = '/tmp/enrichment_cache.sqlite'
+    article_index_file_path = '/tmp/article_index.sqlite'
+    processed_destination_name = f'{config["OUTPUT_BUCKET_PREFIX"]}processed_article_data_{current_timestamp_str}'
 
-    download_pubmed_xml_file(s3, config["INPUT_BUCKET_NAME"], 'Annie/', pubmed_xml_file_path)
+    download_sqlite_file(s3, config["OUTPUT_BUCKET_NAME"], config["ENRICHMENT_CACHE_KEY"], enrichment_cache_file_path)
 
-    if not os.path.exists(pubmed_xml_file_path):
-        raise FileNotFoundError(f"File {pubmed_xml_file_path} not found.")
+    cache = EnrichmentCache(enrichment_cache_file_path, resources["enrichment_cache_version"], config["ENRICHMENT_CACHE_MAX_ENTRIES"])
 
-    tree = ET.parse(pubmed_xml_file_path)
+    article_index = None
 
-    root = tree.getroot()
+    if config["INCREMENTAL"]:
 
-    # data = get_all_data_for_each_article(root, len(root.findall(".//PubmedArticle")))
+        download_sqlite_file(s3, config["OUTPUT_BUCKET_NAME"], config["ARTICLE_INDEX_KEY"], article_index_file_path)
 
-    data = get_all_data_for_each_article(root, 50)
+        article_index = ArticleIndex(article_index_file_path, resources["enrichment_cache_version"],
+                                     config["ARTICLE_INDEX_MAX_ENTRIES"])
 
-    flattened_data = flatten_article_data(data)
+    if config["INGEST_MODE"] == "batch":
 
-    df = pd.DataFrame(flattened_data)
+        run_batch_ingestion(s3, s3, resources, config, cache, processed_destination_name,
+                            lambda pubmed_xml_source: flatten_article_chunks(stream_pubmed_articles(pubmed_xml_source), config["ARTICLE_CHUNK_SIZE"]),
+                            article_index)
 
-    df = find_email_zipcode(df)
+    else:
 
-    # enrich:
+        pubmed_key = find_most_recent_pubmed_key(s3, config["INPUT_BUCKET_NAME"], config["INPUT_BUCKET_PREFIX"])
 
-    nlp = spacy.load("en_core_web_sm")
+        if pubmed_key is None:
+            raise FileNotFoundError(f"No PubMed .xml file found in {config['INPUT_BUCKET_NAME']}.")
 
-    docs = df['affiliation'].apply(nlp)
+        open_output = get_s3_output_opener(s3, config["OUTPUT_BUCKET_NAME"], processed_destination_name)
 
-    world_countries = get_world_countries_list("./world_countries.txt")
+        writer = create_output_writer(config["OUTPUT_FORMAT"], open_output)
 
-    identified_countries_list = identify_countries(docs, world_countries)
+        with open_pubmed_xml_stream(s3, config["INPUT_BUCKET_NAME"], pubmed_key) as pubmed_xml_source:
 
-    df['country'] = identified_countries_list
+            row_chunks = flatten_article_chunks(stream_pubmed_articles(pubmed_xml_source), config["ARTICLE_CHUNK_SIZE"])
 
-    identified_institutions_list, grid_institutions_list = identify_institutions(docs, grid_institutions_df)
+            run_pipeline(row_chunks, resources, config, cache, writer, article_index, s3, processed_destination_name)
 
-    df['institutions'] = identified_institutions_list
+    cache.close()
 
-    df['grid_institutions'] = grid_institutions_list
-    
-    df['identity'] = df.apply(find_grid_id, args=(grid_institutions_df,), axis=1)
-    
-    df.to_csv(processed_csv_file_path, index=False)
+    upload_sqlite_file(s3, config["OUTPUT_BUCKET_NAME"], config["ENRICHMENT_CACHE_KEY"], enrichment_cache_file_path)
+
+    if article_index is not None:
+
+        article_index.close()
+
+        upload_sqlite_file(s3, config["OUTPUT_BUCKET_NAME"], config["ARTICLE_INDEX_KEY"], article_index_file_path)
+
+    with metrics.stage("sns_publish"):
+        sns.publish(
+            TopicArn='arn:aws:sns:eu-west-2:129033205317:c8-annie-pharmazer-notif',
+            Message='New article data processed',
+        )
 
-    s3.upload_file(processed_csv_file_path, config["OUTPUT_BUCKET_NAME"], processed_csv_destination_key)
+    run_metrics = metrics.summary()
 
-    sns.publish(
-        TopicArn='arn:aws:sns:eu-west-2:129033205317:c8-annie-pharmazer-notif',
-        Message='New article data processed',
-    )
+    logger.info("Pipeline metrics: %s", json.dumps(run_metrics))
 
     return {
         'statusCode': 200,
-        'body': 'CSV file uploaded successfully'
+        'body': json.dumps({'message': 'Processed article data uploaded successfully', 'metrics': run_metrics})
     }
 
 
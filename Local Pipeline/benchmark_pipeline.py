@@ -0,0 +1,558 @@
+import os
+import re
+import argparse
+import tempfile
+import resource
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from collections.abc import Iterable
+import spacy
+import xml.etree.ElementTree as ET
+from xml.etree.ElementTree import Element
+import pandas as pd
+from pandas import DataFrame
+from rapidfuzz.process_cpp import extractOne
+from rapidfuzz.distance import Levenshtein
+from processing_pipeline import (get_all_data_for_each_article, get_author_info_from_article_num, get_author_info,
+                                 GridMatcher, stream_pubmed_articles, flatten_article_data,
+                                 extract_articles_in_parallel, find_contact_details, create_output_writer,
+                                 get_s3_output_opener, LocalS3Client, CountryMatcher, identify_countries,
+                                 get_world_countries_list, load_ner_model, extract_entities,
+                                 find_institution_segments, find_institutions, INSTITUTION_KEYWORDS,
+                                 ENRICHMENT_COLUMNS, CATEGORICAL_COLUMNS, encode_categorical_columns, find_grid_ids)
+
+
+DEFAULT_XML_FILE_PATH = "./tmp/pubmed_result_sjogren.xml"
+DEFAULT_GRID_DIR = "/GRID_Data"
+DEFAULT_WORLD_COUNTRIES_FILE_PATH = "./world_countries.txt"
+
+# The number of affiliation rows that contact detail extraction is timed on
+CONTACT_CORPUS_ROWS = 1_000_000
+
+# The per-article lookup gets very slow on large files, so it is only timed up to this count
+PER_ARTICLE_LOOKUP_LIMIT = 1000
+
+
+def time_call(func, *args) -> float:
+    """
+    Returns how long (in seconds) a single
+    call of the given function takes
+    """
+    start = perf_counter()
+    func(*args)
+    return perf_counter() - start
+
+
+def get_article_counts(total_articles: int, steps: int = 4) -> list[int]:
+    """
+    Returns an increasing list of article counts,
+    doubling up to the total number of articles
+    """
+    return sorted({max(1, total_articles >> step) for step in range(steps)})
+
+
+def get_data_by_article_num(root: Element, article_cap: int) -> list[dict]:
+    """
+    The old way of extracting the articles, which
+    searches the whole tree again for every article
+    """
+    return [get_author_info_from_article_num(root, i) for i in range(article_cap)]
+
+
+def benchmark_article_extraction(root: Element) -> None:
+    """
+    Prints the time taken to extract increasing
+    numbers of articles, using both the single-pass
+    and the per-article-lookup approaches
+    """
+    total_articles = len(root.findall(".//PubmedArticle"))
+
+    print("articles | single pass (s) | per article (s) | single pass per article (ms)")
+
+    for article_count in get_article_counts(total_articles):
+
+        single_pass = time_call(get_all_data_for_each_article, root, article_count)
+
+        if article_count <= PER_ARTICLE_LOOKUP_LIMIT:
+            per_article = f"{time_call(get_data_by_article_num, root, article_count):15.4f}"
+        else:
+            per_article = f"{'-':>15}"
+
+        print(f"{article_count:8} | {single_pass:15.4f} | {per_article} | {1000 * single_pass / article_count:.4f}")
+
+
+def get_author_info_by_find(author: Element) -> dict:
+    """
+    The old way of extracting an author's details,
+    which searches the author's subtree twice per field
+    """
+    forename = author.find(".//ForeName").text if author.find(".//ForeName") is not None else None
+    lastname = author.find(".//LastName").text if author.find(".//LastName") is not None else None
+    initials = author.find(".//Initials").text if author.find(".//Initials") is not None else None
+    affiliation_name_pubmed = author.find(".//AffiliationInfo/Affiliation").text if author.find(".//AffiliationInfo/Affiliation") is not None else None
+    identity = author.find(".//AffiliationInfo/Identifier[@Source='GRID']").text if author.find(".//AffiliationInfo/Identifier[@Source='GRID']") is not None else None
+
+    affiliation_list = [aff.text for aff in author.findall(".//Affiliation")]
+
+    return {
+        "forename": forename,
+        "lastname": lastname,
+        "initials": initials,
+        "identity": identity,
+        "affiliation_name": affiliation_name_pubmed,
+        "affiliation": affiliation_list
+    }
+
+
+def benchmark_author_extraction(root: Element, repeats: int = 5) -> None:
+    """
+    Prints the average cost per author of the
+    old and new author extraction functions, and
+    checks that both give the same output
+    """
+    authors = root.findall(".//AuthorList/Author")
+
+    if [get_author_info_by_find(author) for author in authors] != [get_author_info(author) for author in authors]:
+        raise ValueError("Author extraction outputs do not match")
+
+    print("\nauthors | before (us/author) | after (us/author)")
+
+    before = min(time_call(lambda: [get_author_info_by_find(author) for author in authors]) for _ in range(repeats))
+    after = min(time_call(lambda: [get_author_info(author) for author in authors]) for _ in range(repeats))
+
+    print(f"{len(authors):7} | {1e6 * before / len(authors):18.3f} | {1e6 * after / len(authors):17.3f}")
+
+
+def get_institution_queries(root: Element) -> list[str]:
+    """
+    Returns the unique comma-separated parts of
+    the affiliations that look like institution
+    names, to use as fuzzy matching queries
+    """
+    queries = set()
+
+    for affiliation in root.iter("Affiliation"):
+        for part in (affiliation.text or "").split(","):
+            part = part.strip()
+            if any(keyword in part.lower() for keyword in INSTITUTION_KEYWORDS):
+                queries.add(part)
+
+    return sorted(queries)
+
+
+def brute_force_match(grid_institutions_df: DataFrame, query: str, threshold: float) -> str:
+    """
+    The old way of fuzzy matching, which scores
+    every GRID name for every query
+    """
+    grid_institution = extractOne(query, grid_institutions_df['name'],
+                                  scorer=Levenshtein.normalized_similarity,
+                                  score_cutoff=threshold)
+
+    return grid_institution[0] if grid_institution else None
+
+
+def benchmark_grid_matching(grid_institutions_df: DataFrame, queries: list[str], threshold: float = 0.9) -> None:
+    """
+    Prints the recall and the average latency of
+    the indexed GRID matcher, compared against
+    the brute force matches
+    """
+    start = perf_counter()
+    grid_matcher = GridMatcher(grid_institutions_df['name'].tolist())
+    build_time = perf_counter() - start
+
+    start = perf_counter()
+    expected = [brute_force_match(grid_institutions_df, query, threshold) for query in queries]
+    brute_force_time = perf_counter() - start
+
+    start = perf_counter()
+    found = [grid_matcher.match(query, threshold) for query in queries]
+    indexed_time = perf_counter() - start
+
+    start = perf_counter()
+    batch_found = grid_matcher.match_many(queries, threshold)
+    batch_time = perf_counter() - start
+
+    if batch_found != found:
+        raise ValueError("Batch and indexed GRID matches do not match")
+
+    expected_matches = sum(match is not None for match in expected)
+    same_matches = sum(match is not None and match == found_match for match, found_match in zip(expected, found))
+    recall = same_matches / expected_matches if expected_matches else 1.0
+
+    print(f"\nGRID matching: {len(queries)} queries, {len(grid_institutions_df)} names, index built in {build_time:.2f}s")
+    print(f"recall vs brute force: {recall:.4f} ({same_matches} of {expected_matches} matches)")
+    print(f"brute force: {1000 * brute_force_time / len(queries):.3f} ms/query | indexed: {1000 * indexed_time / len(queries):.3f} ms/query"
+          f" | batch cdist: {1000 * batch_time / len(queries):.3f} ms/query")
+
+
+def identify_countries_by_ner(entities: list[list[tuple[str, str]]], world_countries: list[str]) -> list[str]:
+    """
+    The old way of finding countries, which keeps
+    the last spaCy GPE entity that is in the
+    world countries list
+    """
+    world_countries = set(world_countries)
+
+    countries_list = []
+
+    for text_entities in entities:
+        countries_found = [text for text, label in text_entities if label == "GPE" and text.title() in world_countries]
+        countries_list.append(countries_found[-1] if countries_found else None)
+
+    return countries_list
+
+
+def benchmark_country_detection(root: Element, nlp, world_countries: list[str], examples: int = 10) -> None:
+    """
+    Prints the time per affiliation of the spaCy
+    and gazetteer country detection, how often
+    they agree (comparing the spaCy text by its
+    world_countries.txt name), and some of the
+    affiliations where they differ
+    """
+    affiliations = sorted({affiliation.text for affiliation in root.iter("Affiliation") if affiliation.text})
+
+    start = perf_counter()
+    ner_countries = identify_countries_by_ner(extract_entities(nlp, affiliations, 256, 1), world_countries)
+    ner_time = perf_counter() - start
+
+    start = perf_counter()
+    country_matcher = CountryMatcher(world_countries)
+    build_time = perf_counter() - start
+
+    start = perf_counter()
+    gazetteer_countries = identify_countries(affiliations, country_matcher)
+    gazetteer_time = perf_counter() - start
+
+    ner_countries = [country_matcher.match(country) if country else None for country in ner_countries]
+    pairs = list(zip(ner_countries, gazetteer_countries))
+
+    print(f"\ncountry detection: {len(affiliations)} unique affiliations, gazetteer built in {1000 * build_time:.1f}ms")
+    print(f"spaCy: {1e6 * ner_time / len(affiliations):.1f} us/affiliation | gazetteer: {1e6 * gazetteer_time / len(affiliations):.1f} us/affiliation")
+    print(f"agree: {sum(ner == gazetteer for ner, gazetteer in pairs)} | gazetteer only: {sum(ner is None and gazetteer is not None for ner, gazetteer in pairs)}"
+          f" | spaCy only: {sum(ner is not None and gazetteer is None for ner, gazetteer in pairs)}"
+          f" | different: {sum(None not in (ner, gazetteer) and ner != gazetteer for ner, gazetteer in pairs)}")
+
+    differences = [(affiliation, ner, gazetteer) for affiliation, (ner, gazetteer) in zip(affiliations, pairs) if ner != gazetteer]
+
+    for affiliation, ner, gazetteer in differences[:examples]:
+        print(f"  spaCy: {ner} | gazetteer: {gazetteer} | {affiliation}")
+
+
+def find_institutions_by_ner(entities: list[list[tuple[str, str]]]) -> list[str]:
+    """
+    The old way of finding institutions, which keeps
+    the first spaCy ORG entity with an institution
+    keyword
+    """
+    institutions_list = []
+
+    for text_entities in entities:
+        institutions_found = [text for text, label in text_entities if label == "ORG" and any(keyword in text.lower() for keyword in INSTITUTION_KEYWORDS)]
+        institutions_list.append(institutions_found[0] if institutions_found else None)
+
+    return institutions_list
+
+
+def benchmark_institution_extraction(root: Element, nlp, examples: int = 10) -> None:
+    """
+    Prints the throughput of institution extraction
+    with spaCy alone and with the comma segment fast
+    path (falling back to spaCy), how often the
+    fallback is used, and how often the two agree
+    """
+    affiliations = sorted({affiliation.text for affiliation in root.iter("Affiliation") if affiliation.text})
+    config = {"NER_BATCH_SIZE": 256, "NER_N_PROCESS": 1}
+
+    start = perf_counter()
+    ner_institutions = find_institutions_by_ner(extract_entities(nlp, affiliations, config["NER_BATCH_SIZE"], config["NER_N_PROCESS"]))
+    ner_time = perf_counter() - start
+
+    start = perf_counter()
+    fast_institutions = find_institutions(affiliations, nlp, config)
+    fast_time = perf_counter() - start
+
+    fallback_count = len(find_institution_segments(affiliations)[1])
+    agree = sum(ner == fast for ner, fast in zip(ner_institutions, fast_institutions))
+
+    print(f"\ninstitution extraction: {len(affiliations)} unique affiliations, spaCy fallback for {fallback_count}"
+          f" ({100 * fallback_count / len(affiliations):.1f}%)")
+    print(f"spaCy: {len(affiliations) / ner_time:.0f} affiliations/s | fast path: {len(affiliations) / fast_time:.0f} affiliations/s"
+          f" | speedup: {ner_time / fast_time:.1f}x")
+    print(f"agree: {agree} | fast path only: {sum(ner is None and fast is not None for ner, fast in zip(ner_institutions, fast_institutions))}"
+          f" | spaCy only: {sum(ner is not None and fast is None for ner, fast in zip(ner_institutions, fast_institutions))}"
+          f" | different: {sum(None not in (ner, fast) and ner != fast for ner, fast in zip(ner_institutions, fast_institutions))}")
+
+    differences = [(affiliation, ner, fast) for affiliation, ner, fast in zip(affiliations, ner_institutions, fast_institutions) if ner != fast]
+
+    for affiliation, ner, fast in differences[:examples]:
+        print(f"  spaCy: {ner} | fast path: {fast} | {affiliation}")
+
+
+def find_email_zipcode(df: DataFrame) -> DataFrame:
+    """
+    The old way of finding email addresses and
+    zipcodes, with a separate pass over every row
+    for each
+    """
+    df['author_email'] = df['affiliation'].str.extract(r'([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})')
+    df['zipcode'] = df['affiliation'].str.extract(r'(\b\d{5}(?:-\d{4})?\b|\b[A-Z]\d[A-Z] \d[A-Z]\b|\b[A-Z]\d[A-Z]\d[A-Z]\b)', flags=re.IGNORECASE)
+
+    return df
+
+
+def get_unique_suffix(i: int) -> str:
+    """
+    Returns a distinct run of letters for each
+    number, to make copies of an affiliation
+    unique without adding digits
+    """
+    letters = ""
+
+    while True:
+        i, remainder = divmod(i, 26)
+        letters += chr(ord("a") + remainder)
+        if not i:
+            return letters
+
+
+def benchmark_contact_extraction(root: Element, row_count: int = CONTACT_CORPUS_ROWS) -> None:
+    """
+    Prints the throughput of the old two-pass email
+    and zipcode extraction and of the single-scan
+    contact details extraction, over a corpus of
+    row_count affiliations built from the file's
+    affiliations, both as repeated (as in PubMed)
+    and as all-unique affiliations
+    """
+    affiliations = [affiliation.text for affiliation in root.iter("Affiliation") if affiliation.text]
+
+    corpora = {
+        "repeated": [affiliations[i % len(affiliations)] for i in range(row_count)],
+        "unique": [f"{affiliations[i % len(affiliations)]} Unit {get_unique_suffix(i)}" for i in range(row_count)]
+    }
+
+    print(f"\ncorpus   | two passes (rows/s) | single scan (rows/s) | speedup ({row_count} rows)")
+
+    for corpus_name, corpus in corpora.items():
+
+        before = time_call(find_email_zipcode, DataFrame({"affiliation": corpus}))
+        after = time_call(find_contact_details, DataFrame({"affiliation": corpus}))
+
+        print(f"{corpus_name:8} | {row_count / before:19.0f} | {row_count / after:20.0f} | {before / after:.2f}x")
+
+
+def extract_articles_sequentially(xml_file_path: str) -> dict[str, list]:
+    """
+    Extracts and flattens the articles of a PubMed
+    .xml file in a single process
+    """
+    return flatten_article_data(stream_pubmed_articles(xml_file_path))
+
+
+def benchmark_sharded_extraction(xml_file_path: str, max_workers: int) -> None:
+    """
+    Prints the time taken to extract and flatten
+    the whole file with increasing numbers of
+    worker processes, checking that the rows match
+    the single-process output
+    """
+    start = perf_counter()
+    expected = extract_articles_sequentially(xml_file_path)
+    sequential_time = perf_counter() - start
+
+    print(f"\nworkers | extract + flatten (s) | speedup ({len(expected['pmid'])} rows)")
+    print(f"{1:7} | {sequential_time:21.4f} | {1:7.2f}")
+
+    workers = 2
+    while workers <= max_workers:
+
+        start = perf_counter()
+        rows = extract_articles_in_parallel(xml_file_path, workers)
+        parallel_time = perf_counter() - start
+
+        if rows != expected:
+            raise ValueError(f"Sharded extraction with {workers} workers does not match")
+
+        print(f"{workers:7} | {parallel_time:21.4f} | {sequential_time / parallel_time:7.2f}")
+
+        workers *= 2
+
+
+def flatten_article_data_to_rows(article_data: Iterable[dict]) -> list[dict]:
+    """
+    The old flattening, which builds a dictionary
+    for every row
+    """
+    return [
+        {
+            "title": article['title'],
+            "pmid": article['pmid'],
+            "year": article['year'],
+            "keyword_list": article['keyword_list'],
+            "mesh_list": article['mesh_list'],
+            "author_index": author_index,
+            "affiliation_index": affiliation_index,
+            "forename": author['forename'],
+            "lastname": author['lastname'],
+            "full_name": " ".join(filter(None, (author['forename'], author['lastname']))),
+            "initials": author['initials'],
+            "identity": author['identity'],
+            "affiliation": affiliation
+        }
+        for article in article_data
+        for author_index, author in enumerate(article['authors_info'])
+        for affiliation_index, affiliation in enumerate(author['affiliation'])
+    ]
+
+
+def build_dataframe_from_rows(xml_file_path: str) -> int:
+    """
+    Builds the file's DataFrame from row
+    dictionaries, returning its row count
+    """
+    return len(pd.DataFrame(flatten_article_data_to_rows(stream_pubmed_articles(xml_file_path))))
+
+
+def build_dataframe_from_columns(xml_file_path: str) -> int:
+    """
+    Builds the file's DataFrame from columns,
+    returning its row count
+    """
+    return len(pd.DataFrame(flatten_article_data(stream_pubmed_articles(xml_file_path))))
+
+
+def measure_peak_memory(build_dataframe, xml_file_path: str) -> tuple[float, float, int]:
+    """
+    Returns the time taken, the rise in peak RSS
+    (in MB) and the row count of the given build,
+    measured in the process it runs in
+    """
+    # ru_maxrss is in kilobytes on Linux
+    peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = perf_counter()
+    row_count = build_dataframe(xml_file_path)
+    build_time = perf_counter() - start
+    peak_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return build_time, (peak_after - peak_before) / 1024, row_count
+
+
+def benchmark_dataframe_memory(xml_file_path: str) -> None:
+    """
+    Prints the time taken and peak RSS growth of
+    building the whole file's DataFrame from row
+    dictionaries and from columns, each in a fresh
+    process so that neither inherits the other's
+    peak
+    """
+    print("\nbuilt from | time (s) | peak RSS growth (MB)")
+
+    for name, build_dataframe in (("rows", build_dataframe_from_rows), ("columns", build_dataframe_from_columns)):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            build_time, peak_growth, row_count = executor.submit(measure_peak_memory, build_dataframe, xml_file_path).result()
+
+        print(f"{name:10} | {build_time:8.4f} | {peak_growth:20.1f} ({row_count} rows)")
+
+
+def benchmark_categorical_encoding(xml_file_path: str, repeats: int = 5) -> None:
+    """
+    Prints the memory used by the repeated columns
+    and the time taken to find the GRID IDs, with
+    the columns held as plain strings and as
+    categoricals. The institutions are taken from
+    the affiliations by the rule-based extraction,
+    and every other distinct institution is given a
+    made-up GRID ID (by name or by alias)
+    """
+    df = pd.DataFrame(extract_articles_sequentially(xml_file_path))
+
+    institutions = find_institution_segments(df['affiliation'].tolist())[0]
+    df['institutions'] = pd.Series(institutions, dtype=object)
+    df['grid_institutions'] = df['institutions']
+    df['country'] = None
+
+    distinct_institutions = df['institutions'].dropna().unique().tolist()
+    name_index = {name: f"grid.{i}" for i, name in enumerate(distinct_institutions[::4])}
+    alias_index = {name: f"grid.alias.{i}" for i, name in enumerate(distinct_institutions[1::4])}
+
+    categorical_df = encode_categorical_columns(df.copy())
+
+    print(f"\nencoding    | repeated columns (MB) | find_grid_ids (s) ({len(df)} rows)")
+
+    for name, frame in (("strings", df), ("categorical", categorical_df)):
+        memory = frame[CATEGORICAL_COLUMNS].memory_usage(deep=True, index=False).sum()
+        lookup_time = min(time_call(find_grid_ids, frame, name_index, alias_index) for _ in range(repeats))
+
+        print(f"{name:11} | {memory / 1e6:21.3f} | {lookup_time:17.4f}")
+
+
+def benchmark_output_formats(xml_file_path: str, chunk_size: int = 1000) -> None:
+    """
+    Prints the write time and output size of the
+    flat .csv and normalised Parquet output formats,
+    streamed to a local stand-in for S3, for the
+    file's rows (with only the contact details
+    filled in)
+    """
+    df = pd.DataFrame(extract_articles_sequentially(xml_file_path))
+    df = find_contact_details(df)
+
+    for column in ENRICHMENT_COLUMNS:
+        if column not in df:
+            df[column] = None
+
+    # Each chunk is encoded separately, as in the pipeline, so it only carries its own categories
+    chunks = [encode_categorical_columns(df.iloc[i:i + chunk_size].copy()) for i in range(0, len(df), chunk_size)]
+
+    print(f"\nformat  | write (s) | size (MB) ({len(df)} rows)")
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for output_format in ("csv", "parquet"):
+
+            open_output = get_s3_output_opener(LocalS3Client(output_dir), "benchmark", f"processed_article_data_{output_format}")
+
+            start = perf_counter()
+            writer = create_output_writer(output_format, open_output)
+            for chunk in chunks:
+                writer.write(chunk)
+            writer.close()
+            write_time = perf_counter() - start
+
+            output_size = sum(os.path.getsize(os.path.join(output_dir, output.name.removeprefix("s3://")))
+                              for output in writer.outputs)
+
+            print(f"{output_format:7} | {write_time:9.4f} | {output_size / 1e6:9.3f}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks stages of the PubMed processing pipeline")
+    parser.add_argument("xml_file_path", nargs="?", default=DEFAULT_XML_FILE_PATH)
+    parser.add_argument("--grid-dir", default=DEFAULT_GRID_DIR)
+    parser.add_argument("--world-countries", default=DEFAULT_WORLD_COUNTRIES_FILE_PATH)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="the most worker processes to time sharded extraction with")
+    args = parser.parse_args()
+
+    tree = ET.parse(args.xml_file_path)
+
+    benchmark_article_extraction(tree.getroot())
+    benchmark_author_extraction(tree.getroot())
+    benchmark_sharded_extraction(args.xml_file_path, args.workers)
+    benchmark_dataframe_memory(args.xml_file_path)
+    benchmark_categorical_encoding(args.xml_file_path)
+    benchmark_output_formats(args.xml_file_path)
+    benchmark_contact_extraction(tree.getroot())
+
+    if spacy.util.is_package("en_core_web_sm"):
+        nlp = load_ner_model()
+        benchmark_country_detection(tree.getroot(), nlp, get_world_countries_list(args.world_countries))
+        benchmark_institution_extraction(tree.getroot(), nlp)
+
+    institutes_file_path = os.path.join(args.grid_dir, "institutes.csv")
+
+    if os.path.exists(institutes_file_path):
+        benchmark_grid_matching(pd.read_csv(institutes_file_path), get_institution_queries(tree.getroot()))
@@ -0,0 +1,361 @@
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+from time import perf_counter
+from xml.sax.saxutils import escape
+import pandas as pd
+import spacy
+from processing_pipeline import (stream_pubmed_articles, flatten_article_chunks, run_pipeline, create_output_writer,
+                                 get_s3_output_opener, LocalS3Client, load_grid_data, CountryMatcher,
+                                 get_world_countries_list, load_ner_model, get_timestamp, metrics)
+
+
+DEFAULT_WORLD_COUNTRIES_FILE_PATH = "./world_countries.txt"
+DEFAULT_RESULTS_DIR = "./benchmark_results"
+
+# The article counts each stage is timed at
+BENCHMARK_ARTICLE_COUNTS = [1000, 10000, 100000]
+
+# Seeds the generator, so every run (and every commit) is benchmarked on the same data
+SYNTHETIC_SEED = 0
+
+# Syllables joined into made-up place and person names
+NAME_SYLLABLES = ["ka", "lo", "mi", "ren", "sa", "tor", "vel", "dan", "bri", "gu", "ha", "nel", "os", "pra", "quin",
+                  "ri", "sten", "ul", "wes", "zo"]
+
+# Institution names, which are filled in with a place name (the keywords match INSTITUTION_KEYWORDS)
+INSTITUTION_TEMPLATES = ["University of {place}", "{place} University Hospital", "{place} Medical Center",
+                         "{place} Centre for Cancer Research", "National Laboratory of {place}", "{place} Institute of Science"]
+
+DEPARTMENTS = ["Department of Rheumatology", "Department of Medicine", "Division of Immunology",
+               "School of Public Health", "Department of Oral Medicine", "Faculty of Dentistry"]
+
+# Country names as they are often written in affiliations, alongside those in world_countries.txt
+COUNTRY_ALIASES = ["USA", "UK", "P.R. China"]
+
+# How often a generated affiliation names an institution by its GRID alias, misspells it, or names one that
+# isn't in the GRID data at all
+ALIAS_RATE = 0.15
+MISSPELLING_RATE = 0.1
+UNKNOWN_INSTITUTION_RATE = 0.1
+
+# How often an author's affiliation carries a GRID identifier in the PubMed data
+GRID_IDENTIFIER_RATE = 0.05
+
+# How often a generated affiliation's institution can't be taken from its comma segments, so is left to spaCy.
+# Half of these have a street address (with a keyword and digits) before the institution, and half have the
+# institution written out at more than INSTITUTION_SEGMENT_MAX_WORDS words
+NER_FALLBACK_RATE = 0.2
+STREET_ADDRESS_TEMPLATE = "{number} University Avenue"
+LONG_INSTITUTION_TEMPLATE = "{name} and the Affiliated Teaching Hospitals of the {place} Regional Health Authority"
+
+
+def make_name(rng: random.Random, syllables: int) -> str:
+    """
+    Returns a made-up capitalised name built from
+    the given number of syllables
+    """
+    return "".join(rng.choice(NAME_SYLLABLES) for _ in range(syllables)).capitalize()
+
+
+def generate_grid_data(grid_dir: str, institution_count: int, seed: int = SYNTHETIC_SEED) -> list[dict]:
+    """
+    Writes a synthetic GRID institutes.csv and
+    aliases.csv (one alias for every third
+    institution) to the given folder, returning
+    the institutions (name, GRID ID and alias)
+    """
+    rng = random.Random(seed)
+    names = set()
+    institutions = []
+
+    while len(institutions) < institution_count:
+        name = rng.choice(INSTITUTION_TEMPLATES).format(place=make_name(rng, rng.randint(2, 4)))
+
+        if name in names:
+            continue
+
+        names.add(name)
+        grid_id = f"grid.{len(institutions)}.{rng.randint(0, 99)}"
+        alias = f"{make_name(rng, 3)} {name.split()[-1]}" if len(institutions) % 3 == 0 else None
+        institutions.append({"grid_id": grid_id, "name": name, "alias": alias})
+
+    os.makedirs(grid_dir, exist_ok=True)
+
+    institutions_df = pd.DataFrame(institutions)
+    institutions_df[["grid_id", "name"]].to_csv(os.path.join(grid_dir, "institutes.csv"), index=False)
+    institutions_df.dropna(subset=["alias"])[["grid_id", "alias"]].to_csv(os.path.join(grid_dir, "aliases.csv"), index=False)
+
+    return institutions
+
+
+def make_affiliation(rng: random.Random, institutions: list[dict], countries: list[str], serial: int,
+                     ner_fallback_rate: float = NER_FALLBACK_RATE) -> tuple[str, str]:
+    """
+    Returns a new synthetic affiliation, made unique
+    by its serial number, and the GRID ID of its
+    institution (if it is a GRID institution). Some
+    name the institution by its alias or misspell
+    it, some carry an email address, phone number
+    or postcode, and roughly ner_fallback_rate of
+    them need spaCy to find the institution
+    """
+    institution = rng.choice(institutions)
+    grid_id = institution["grid_id"]
+    name = institution["name"]
+
+    roll = rng.random()
+    if roll < UNKNOWN_INSTITUTION_RATE:
+        name = rng.choice(INSTITUTION_TEMPLATES).format(place=make_name(rng, 5))
+        grid_id = None
+    elif roll < UNKNOWN_INSTITUTION_RATE + MISSPELLING_RATE:
+        i = rng.randrange(len(name))
+        name = name[:i] + name[i + 1:]
+    elif roll < UNKNOWN_INSTITUTION_RATE + MISSPELLING_RATE + ALIAS_RATE and institution["alias"]:
+        name = institution["alias"]
+
+    parts = [f"{rng.choice(DEPARTMENTS)} {serial}", name, make_name(rng, 2)]
+
+    if rng.random() < ner_fallback_rate:
+        if rng.random() < 0.5:
+            parts.insert(1, STREET_ADDRESS_TEMPLATE.format(number=rng.randint(1, 999)))
+        else:
+            parts[1] = LONG_INSTITUTION_TEMPLATE.format(name=name, place=make_name(rng, 2))
+
+    if rng.random() < 0.5:
+        parts.append(f"{rng.randint(10000, 99999)} {rng.choice(countries)}.")
+    else:
+        parts.append(f"{rng.choice(countries)}.")
+
+    affiliation = ", ".join(parts)
+
+    if rng.random() < 0.3:
+        affiliation += f" Tel: +{rng.randint(1, 99)} {rng.randint(100, 999)} {rng.randint(1000000, 9999999)}."
+
+    if rng.random() < 0.4:
+        affiliation += f" Electronic address: {make_name(rng, 2).lower()}.{serial}@{make_name(rng, 2).lower()}.org."
+
+    return affiliation, grid_id
+
+
+def generate_pubmed_xml(xml_file_path: str, article_count: int, institutions: list[dict], countries: list[str],
+                        authors_per_article: int = 5, affiliations_per_author: int = 1,
+                        duplicate_affiliation_ratio: float = 0.8, seed: int = SYNTHETIC_SEED,
+                        ner_fallback_rate: float = NER_FALLBACK_RATE) -> None:
+    """
+    Writes a synthetic PubMed .xml file with the
+    given number of articles. The numbers of
+    authors per article and affiliations per author
+    vary around the given averages, and roughly
+    duplicate_affiliation_ratio of the affiliations
+    repeat one already used, as they do in real
+    PubMed data. Roughly ner_fallback_rate of the
+    unique affiliations are left to spaCy
+    """
+    rng = random.Random(seed)
+    affiliation_pool = []
+
+    with open(xml_file_path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" ?>\n<PubmedArticleSet>\n')
+
+        for i in range(article_count):
+            authors_xml = []
+
+            for _ in range(rng.randint(1, 2 * authors_per_article - 1)):
+                forename, lastname = make_name(rng, 2), make_name(rng, 3)
+                affiliations_xml = []
+
+                for _ in range(rng.randint(1, 2 * affiliations_per_author - 1)):
+                    if affiliation_pool and rng.random() < duplicate_affiliation_ratio:
+                        affiliation, grid_id = rng.choice(affiliation_pool)
+                    else:
+                        affiliation, grid_id = make_affiliation(rng, institutions, countries, len(affiliation_pool), ner_fallback_rate)
+                        affiliation_pool.append((affiliation, grid_id))
+
+                    identifier_xml = (f'<Identifier Source="GRID">{grid_id}</Identifier>'
+                                      if grid_id and rng.random() < GRID_IDENTIFIER_RATE else "")
+                    affiliations_xml.append(f"<AffiliationInfo><Affiliation>{escape(affiliation)}</Affiliation>"
+                                            f"{identifier_xml}</AffiliationInfo>")
+
+                authors_xml.append(f'<Author ValidYN="Y"><LastName>{lastname}</LastName><ForeName>{forename}</ForeName>'
+                                   f'<Initials>{forename[0]}</Initials>{"".join(affiliations_xml)}</Author>')
+
+            keywords_xml = "".join(f'<Keyword MajorTopicYN="N">{make_name(rng, 2).lower()}</Keyword>' for _ in range(3))
+            mesh_xml = "".join(f'<MeshHeading><DescriptorName UI="D{rng.randint(1, 999)}" MajorTopicYN="N">'
+                               f'{make_name(rng, 3)}</DescriptorName></MeshHeading>' for _ in range(3))
+
+            f.write(f'<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">{i + 1}</PMID>'
+                    f'<DateRevised><Year>{rng.randint(2000, 2023)}</Year><Month>01</Month><Day>01</Day></DateRevised>'
+                    f'<Article PubModel="Print"><ArticleTitle>A study of {make_name(rng, 3)} {i}.</ArticleTitle>'
+                    f'<AuthorList CompleteYN="Y">{"".join(authors_xml)}</AuthorList></Article>'
+                    f'<MeshHeadingList>{mesh_xml}</MeshHeadingList><KeywordList Owner="NOTNLM">{keywords_xml}</KeywordList>'
+                    f'</MedlineCitation></PubmedArticle>\n')
+
+        f.write("</PubmedArticleSet>\n")
+
+
+def get_git_commit() -> str:
+    """
+    Returns the commit the code being benchmarked
+    was checked out at, or None outside of git
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_benchmark_ner_model() -> tuple:
+    """
+    Returns the spaCy model used by the pipeline
+    and its name, or a blank English pipeline (with
+    no NER) if the model isn't installed
+    """
+    if spacy.util.is_package("en_core_web_sm"):
+        return load_ner_model(), "en_core_web_sm"
+
+    print("en_core_web_sm is not installed, so the NER stage runs a blank pipeline", file=sys.stderr)
+
+    return spacy.blank("en"), "blank_en"
+
+
+def benchmark_pipeline_run(xml_file_path: str, resources: dict, config: dict, output_dir: str) -> dict:
+    """
+    Runs the whole pipeline over a .xml file (with
+    no enrichment cache, so every affiliation is
+    enriched), writing to a local stand-in for S3,
+    and returns its stage metrics
+    """
+    metrics.reset()
+
+    writer = create_output_writer(config["OUTPUT_FORMAT"], get_s3_output_opener(LocalS3Client(output_dir), "benchmark", "processed_article_data"))
+    row_chunks = flatten_article_chunks(stream_pubmed_articles(xml_file_path), config["ARTICLE_CHUNK_SIZE"])
+
+    row_count = run_pipeline(row_chunks, resources, config, None, writer)
+
+    return {"rows": row_count, **metrics.summary()}
+
+
+def get_ner_fallback_rate(run_metrics: dict) -> float:
+    """
+    Returns the share of the (unique) affiliations
+    whose institution was found with spaCy, rather
+    than taken from a comma segment
+    """
+    stages = run_metrics["stages"]
+    segment_rows = stages.get("institution_segments", {}).get("rows", 0)
+
+    return round(stages.get("ner", {}).get("rows", 0) / segment_rows, 4) if segment_rows else 0.0
+
+
+def print_stage_table(runs: list[dict]) -> None:
+    """
+    Prints the wall time of each stage (in seconds)
+    at each article count
+    """
+    stage_names = list(dict.fromkeys(name for run in runs for name in run["metrics"]["stages"]))
+
+    print(f"\n{'stage':20} | " + " | ".join(f"{run['articles']:>10}" for run in runs))
+
+    for name in stage_names:
+        print(f"{name:20} | " + " | ".join(f"{run['metrics']['stages'].get(name, {}).get('wall_s', 0.0):10.3f}" for run in runs))
+
+    print(f"{'total':20} | " + " | ".join(f"{run['metrics']['wall_s']:10.3f}" for run in runs))
+    print(f"{'peak RSS (MB)':20} | " + " | ".join(f"{run['metrics']['peak_rss_mb']:10.1f}" for run in runs))
+    print(f"{'NER fallback rate':20} | " + " | ".join(f"{run['ner_fallback_rate']:10.3f}" for run in runs))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Times each stage of the pipeline on synthetic PubMed data, "
+                                                 "saving the results as JSON to compare commits")
+    parser.add_argument("--articles", type=int, nargs="+", default=BENCHMARK_ARTICLE_COUNTS)
+    parser.add_argument("--authors-per-article", type=int, default=5)
+    parser.add_argument("--affiliations-per-author", type=int, default=1)
+    parser.add_argument("--duplicate-affiliation-ratio", type=float, default=0.8)
+    parser.add_argument("--ner-fallback-ratio", type=float, default=NER_FALLBACK_RATE,
+                        help="share of unique affiliations whose institution is left to spaCy")
+    parser.add_argument("--grid-institutions", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=SYNTHETIC_SEED)
+    parser.add_argument("--output-format", default="csv", choices=["csv", "parquet"])
+    parser.add_argument("--grid-match-mode", default="batch", choices=["batch", "indexed"])
+    parser.add_argument("--world-countries", default=DEFAULT_WORLD_COUNTRIES_FILE_PATH)
+    parser.add_argument("--data-dir", help="keep the generated .xml files and GRID data in this folder")
+    parser.add_argument("--output", help="the results .json file (by default, one per commit and run in "
+                                         f"{DEFAULT_RESULTS_DIR})")
+    args = parser.parse_args()
+
+    config = {
+        "NER_BATCH_SIZE": 256,
+        "NER_N_PROCESS": 1,
+        "ARTICLE_CHUNK_SIZE": 1000,
+        "OUTPUT_FORMAT": args.output_format,
+        "GRID_MATCH_MODE": args.grid_match_mode
+    }
+
+    parameters = {key: value for key, value in vars(args).items() if key not in ("data_dir", "output", "world_countries")}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_dir = args.data_dir or temp_dir
+        grid_dir = os.path.join(data_dir, "GRID_Data")
+
+        # Leave out names written with qualifiers, e.g. "Ireland {Republic}", which don't appear in affiliations
+        world_countries = [country for country in get_world_countries_list(args.world_countries) if "{" not in country]
+        institutions = generate_grid_data(grid_dir, args.grid_institutions, args.seed)
+
+        nlp, ner_model = load_benchmark_ner_model()
+        resources = {
+            "nlp": nlp,
+            "country_matcher": CountryMatcher(world_countries),
+            "grid_data": load_grid_data(grid_dir)
+        }
+
+        runs = []
+
+        for article_count in args.articles:
+            xml_file_path = os.path.join(data_dir, f"synthetic_pubmed_{article_count}.xml")
+
+            start = perf_counter()
+            generate_pubmed_xml(xml_file_path, article_count, institutions, world_countries + COUNTRY_ALIASES,
+                                args.authors_per_article, args.affiliations_per_author,
+                                args.duplicate_affiliation_ratio, args.seed, args.ner_fallback_ratio)
+            print(f"Generated {article_count} articles in {perf_counter() - start:.1f}s", file=sys.stderr)
+
+            run_metrics = benchmark_pipeline_run(xml_file_path, resources, config, os.path.join(temp_dir, f"output_{article_count}"))
+
+            runs.append({
+                "articles": article_count,
+                "xml_mb": round(os.path.getsize(xml_file_path) / 1e6, 1),
+                "rows": run_metrics.pop("rows"),
+                "ner_fallback_rate": get_ner_fallback_rate(run_metrics),
+                "metrics": run_metrics
+            })
+
+    commit = get_git_commit()
+    timestamp = get_timestamp()
+
+    results = {
+        "commit": commit,
+        "created_at": timestamp,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "spacy": spacy.__version__,
+        "ner_model": ner_model,
+        "parameters": parameters,
+        "runs": runs
+    }
+
+    print_stage_table(runs)
+
+    output_file_path = args.output or os.path.join(DEFAULT_RESULTS_DIR, f"benchmark_{(commit or 'unknown')[:10]}_{timestamp}.json")
+    os.makedirs(os.path.dirname(output_file_path) or ".", exist_ok=True)
+
+    with open(output_file_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"\nResults saved to {output_file_path}")